@@ -48,7 +48,7 @@ USAGE = '''
 NAME
       driver - keep OEC up-to-date with NASA and exoplanet.eu
 SYNOPSIS
-      driver [-h] [--cli] [--auto MAX] CONFIG_FILE
+      driver [-h] [--cli] [--auto MAX] [--changed-only] CONFIG_FILE
 DESCRIPTION
       Fetches data from NASA, list differences between the systems
       in OEC and NASA using a configuration from CONFIG_FILE
@@ -57,6 +57,9 @@ OPTIONS
       --cli     start without graphical-user interface
       --auto N  automatically synchronize and submit at most N requests,
                 then exit immediately
+      --changed-only
+                compare only the systems that changed since the last
+                sync, and every system once per full_sync_interval
 AUTHOR
       Sam Wong, Steven Xia, Melissa Tam, Audrey Cheng, Kc Udonsi
 REPORTING BUGS
@@ -75,6 +78,11 @@ def get_progress_callback():
             print("\n"+tag)
             current_tag[0] = tag
 
+        if total <= 0:
+            # total is unknown, count instead
+            print("\r\tProgress: %d" % current, end='')
+            return
+
         total_blocks = 40
         current = max(0, min(current, total))
         filled_blocks = total_blocks * current // total
@@ -170,7 +178,8 @@ def select_request(syncr: Synchronizer,
             return
 
 
-def sync(config_file: str, max_auto_requests: int=0):
+def sync(config_file: str, max_auto_requests: int=0,
+         changed_only: bool=False):
     """
     Synchronize between OEC and NASA
     """
@@ -185,16 +194,16 @@ def sync(config_file: str, max_auto_requests: int=0):
     # automatic mode
     if max_auto_requests > 0:
         print("Starting auto-sync...")
-        sync_object.sync(sync_callback, get_progress_callback())
+        sync_object.sync(sync_callback, get_progress_callback(),
+                         changed_only)
         req_to_send = local_requests[:max_auto_requests]
-        for req_idx, req in enumerate(req_to_send):
-            try:
-                print("\nSubmitting request %d...\t\t" % req_idx, end="")
-                sync_object.submit(req)
+        print("\nSubmitting %d request(s)..." % len(req_to_send))
+        try:
+            for req in sync_object.submit_many(req_to_send):
                 print("PR #%d (%s)" %
                       (req.pullreq_num, req.pullreq_url))
-            except Exception as ex:
-                logging.exception(ex)
+        except Exception as ex:
+            logging.exception(ex)
         return
 
     # interactive mode
@@ -210,7 +219,8 @@ def sync(config_file: str, max_auto_requests: int=0):
                 "Synchronize",
                 lambda: (
                     local_requests.clear(),
-                    sync_object.sync(sync_callback, get_progress_callback())
+                    sync_object.sync(sync_callback, get_progress_callback(),
+                                     changed_only)
                 ),
                 CliAction.back      # need to regenerate menu text
             ),
@@ -263,16 +273,21 @@ def main():
     parser.add_argument('-h', '--help', action='store_true', default=False)
     parser.add_argument('--cli', action='store_true', default=False)
     parser.add_argument('--auto', metavar='MAX', type=int, default=0)
+    parser.add_argument('--changed-only', action='store_true', default=False)
 
     parser.add_argument('CONFIG_FILE', action='store',
                         help="path to configuration", nargs='?')
     args = parser.parse_args()
 
-    if args.help or args.CONFIG_FILE is None:
+    if args.help:
+        print(USAGE)
+        exit(0)
+    elif args.CONFIG_FILE is None:
         print(USAGE)
         exit(1)
     elif args.cli:
-        sync(args.CONFIG_FILE, max_auto_requests=args.auto)
+        sync(args.CONFIG_FILE, max_auto_requests=args.auto,
+             changed_only=args.changed_only)
     else:
         sync_gui.launch(args.CONFIG_FILE)
     exit(0)
@@ -1,7 +1,12 @@
-from pint import UnitRegistry
 from decimal import Decimal
-from typing import Tuple
+from typing import Tuple, Optional
 from syncutil import SrcPath
+import threading
+import sys
+import hashlib
+import logging
+import json
+import os
 import re
 
 
@@ -9,12 +14,29 @@ class Quantity:
     """
     Representation of a quantity and associated error in a specific
     unit system.
+
+    The value and errors are parsed into Decimal once, when they are set.
+    The original strings are kept for writing them back unchanged.
     """
-    # Load unit registry from module resources
-    _UR = UnitRegistry()
-    _UR.load_definitions(SrcPath.abs('sync/resources/units.txt'))
+    UNIT_DEFINITIONS = SrcPath.abs('sync/resources/units.txt')
+    # bump this whenever the format of the unit table file changes
+    UNIT_TABLE_VERSION = 1
     NUM_REGEX = re.compile(R'[-+]?\d*\.?\d+([eE][-+]?\d+)?')
 
+    # the unit registry is loaded on first use, it takes a while
+    _UR = None
+    _UR_LOCK = threading.Lock()
+
+    # unit table, can be saved so the registry is rarely needed
+    MAX_UNIT_NAMES = 256
+    _UNIT_NAMES = dict()    # unit -> interned canonical unit name
+    # (unit, new unit) -> Decimal scale factor, None to convert through pint
+    _SCALES = dict()
+    _UNIT_TABLE_DIRTY = False
+
+    __slots__ = ('_value', '_unit', '_error', '_is_limit',
+                 '_dec_value', '_dec_error', '_canonical', '_fingerprint')
+
     def __init__(self,
                  value: str,
                  unit: str = None,
@@ -38,24 +60,84 @@ class Quantity:
 
         if error and not is_limit:
             # error-minus and error-plus pair should be non-negative
-            error = (
-                str(abs(Decimal(error[0]))),
-                str(abs(Decimal(error[1])))
-            )
+            dec_error = (abs(Decimal(error[0])), abs(Decimal(error[1])))
+            self._error = (str(dec_error[0]), str(dec_error[1]))
+            self._dec_error = dec_error
+        else:
+            self.error = error
 
         self.value = value
         self.unit = unit
-        self.error = error
-        self.is_limit = is_limit
+        self._is_limit = is_limit
+
+    @property
+    def value(self) -> str:
+        return self._value
+
+    @value.setter
+    def value(self, value: str) -> None:
+        self._dec_value = Decimal(value)
+        self._value = value
+        self._changed()
+
+    @property
+    def unit(self) -> str:
+        return self._unit
+
+    @unit.setter
+    def unit(self, unit: str) -> None:
+        self._unit = unit
+        # canonical name of the unit, None until it is looked up
+        self._canonical = Quantity._UNIT_NAMES.get(unit)
+        self._changed()
+
+    @property
+    def error(self) -> Tuple[str, str]:
+        return self._error
+
+    @error.setter
+    def error(self, error: Tuple[str, str]) -> None:
+        self._dec_error = (Decimal(error[0]), Decimal(error[1])) \
+            if error else None
+        self._error = error
+        self._changed()
+
+    @property
+    def is_limit(self) -> bool:
+        return self._is_limit
+
+    @is_limit.setter
+    def is_limit(self, is_limit: bool) -> None:
+        self._is_limit = is_limit
+        self._changed()
+
+    def _changed(self) -> None:
+        # the fingerprint is outdated
+        self._fingerprint = None
+
+    def __getstate__(self):
+        # the fingerprint is pickled too, so cached systems don't need their
+        # units looked up again
+        return self._value, self._unit, self._error, self._is_limit, \
+            self._fingerprint
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before the quantity had slots
+            state = (state['value'], state['unit'],
+                     state['error'], state['is_limit'])
+        self.value, self.unit, self.error, self._is_limit = state[:4]
+        # pickled without the fingerprint before it was cached
+        self._fingerprint = state[4] if len(state) > 4 else None
 
     def __eq__(self, other: 'Quantity'):
         # keep the type quoted ^, class is incomplete at this point
 
         # value
-        if Decimal(self.value) != Decimal(other.value):
+        if self._dec_value != other._dec_value:
             return False
-        # unit
-        if not self._eq_unit(self.unit, other.unit):
+        # unit, canonical names are interned
+        if self._canonical_unit() is not other._canonical_unit():
             return False
         return True
 
@@ -72,12 +154,61 @@ class Quantity:
         return value is not None and bool(cls.NUM_REGEX.fullmatch(value))
 
     @classmethod
-    def _eq_unit(cls, a: str, b: str) -> bool:
-        if (a is None) != (b is None):
-            return False
-        if a is not None and cls._UR.get_name(a) != cls._UR.get_name(b):
-            return False
-        return True
+    def _registry(cls):
+        """
+        Returns the unit registry, loading it from module resources
+        on first use.
+        """
+        if cls._UR is None:
+            with cls._UR_LOCK:
+                if cls._UR is None:
+                    from pint import UnitRegistry
+                    ur = UnitRegistry()
+                    ur.load_definitions(cls.UNIT_DEFINITIONS)
+                    cls._UR = ur
+        return cls._UR
+
+    @classmethod
+    def _get_unit_name(cls, unit: str) -> str:
+        """
+        Returns the interned canonical name of a unit, looked up once per
+        unit.
+        :param unit: a unit
+        """
+        name = cls._UNIT_NAMES.get(unit)
+        if name is None:
+            name = sys.intern(cls._registry().get_name(unit))
+            if len(cls._UNIT_NAMES) < cls.MAX_UNIT_NAMES:
+                cls._UNIT_NAMES[unit] = name
+                cls._UNIT_TABLE_DIRTY = True
+        return name
+
+    def _canonical_unit(self) -> Optional[str]:
+        """
+        Returns the interned canonical name of the unit of this quantity,
+        so units can be compared by identity.
+        :return: The name, None if the quantity has no unit.
+        """
+        canonical = self._canonical
+        if canonical is None and self._unit is not None:
+            canonical = self._canonical = self._get_unit_name(self._unit)
+        return canonical
+
+    def fingerprint(self) -> tuple:
+        """
+        Returns the canonical form of this quantity. Quantities with equal
+        fingerprints are equal, and neither can update the error of the
+        other. The same tuple is returned until the quantity changes.
+        """
+        fingerprint = self._fingerprint
+        if fingerprint is None:
+            try:
+                unit = self._canonical_unit()
+            except Exception:
+                unit = self._unit   # undefined unit, only equal to itself
+            fingerprint = self._fingerprint = \
+                (self._dec_value, unit, self._dec_error, self._is_limit)
+        return fingerprint
 
     def to(self, new_unit: str) -> 'Quantity':
         """
@@ -85,31 +216,132 @@ class Quantity:
         :param new_unit: The target unit system.
         :return: A new quantity value using the target unit system
         """
-        def conv(original: str) -> str:
+        def conv(original: Decimal) -> str:
             """
             Converts a value from current unit to the new_unit
-            :param original: string representing a number
+            :param original: the number
             :return: string representing converted number
             """
-            # Decimal type is not so well supported in pint package
-            # but it preserves precisions and doesn't have numeric errors
-            #
-            # It fails if the conversion between two units involves an offset
-            # e.g. Kelvin -> Celsius
-            old = self._UR.Quantity(Decimal(original), self.unit)
-            new = old.to(new_unit)
-            return str(new.magnitude)
+            return str(self._convert(original, self.unit, new_unit))
 
         return Quantity(
-            conv(self.value),
+            conv(self._dec_value),
             new_unit,
             None if not self.error else (
-                conv(self.error[0]),
-                conv(self.error[1]),
+                conv(self._dec_error[0]),
+                conv(self._dec_error[1]),
             ),
             self.is_limit
         )
 
+    @classmethod
+    def _convert(cls, value: Decimal, unit: str, new_unit: str) -> Decimal:
+        """
+        Converts a number between two units. The scale factor of each pair
+        of units is resolved through pint once, and then applied with
+        Decimal arithmetic.
+        :param value: the number
+        :param unit: the unit of the number
+        :param new_unit: the target unit
+        :return: the converted number
+        """
+        key = (unit, new_unit)
+        try:
+            scale = cls._SCALES[key]
+        except KeyError:
+            scale = cls._SCALES[key] = cls._get_scale(unit, new_unit, value)
+            cls._UNIT_TABLE_DIRTY = True
+        if scale is None:
+            return cls._convert_pint(value, unit, new_unit)
+        return value * scale
+
+    @classmethod
+    def _convert_pint(cls, value: Decimal, unit: str, new_unit: str) \
+            -> Decimal:
+        # Decimal type is not so well supported in pint package
+        # but it preserves precisions and doesn't have numeric errors
+        #
+        # It fails if the conversion between two units involves an offset
+        # e.g. Kelvin -> Celsius
+        return cls._registry().Quantity(value, unit).to(new_unit).magnitude
+
+    @classmethod
+    def _get_scale(cls, unit: str, new_unit: str, sample: Decimal) \
+            -> Optional[Decimal]:
+        """
+        Resolves the scale factor between two units.
+        :param unit: the source unit
+        :param new_unit: the target unit
+        :param sample: a number to check the factor against pint with
+        :return: the scale factor, or None if the conversion is not a plain
+        scale giving the same digits as pint (e.g. it involves an offset)
+        """
+        try:
+            scale = cls._convert_pint(Decimal(1), unit, new_unit)
+            if not isinstance(scale, Decimal) or \
+                    cls._convert_pint(Decimal(0), unit, new_unit) != 0 or \
+                    str(sample * scale) != \
+                    str(cls._convert_pint(sample, unit, new_unit)):
+                return None
+            return scale
+        except Exception:
+            return None     # let pint raise the error on conversion
+
+    @classmethod
+    def load_unit_table(cls, file: str) -> None:
+        """
+        Loads unit names and scale factors saved by save_unit_table. A
+        missing or outdated file is ignored.
+        :param file: Path to the unit table file.
+        """
+        try:
+            with open(file, 'r') as f:
+                table = json.load(f)
+            if table.get('key') != cls._unit_table_key():
+                logging.info("Discarding outdated unit table")
+                return
+            for unit, name in table['names'].items():
+                if len(cls._UNIT_NAMES) >= cls.MAX_UNIT_NAMES:
+                    break
+                cls._UNIT_NAMES[unit] = sys.intern(name)
+            for unit, new_unit, scale in table['scales']:
+                cls._SCALES[(unit, new_unit)] = \
+                    Decimal(scale) if scale is not None else None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug("Unable to load unit table: %s" % e)
+
+    @classmethod
+    def save_unit_table(cls, file: str) -> None:
+        """
+        Saves the unit names and scale factors looked up so far, if there
+        are new ones.
+        :param file: Path to the unit table file.
+        """
+        if not cls._UNIT_TABLE_DIRTY:
+            return
+        table = {
+            'key': cls._unit_table_key(),
+            'names': dict(cls._UNIT_NAMES),
+            'scales': [[unit, new_unit,
+                        str(scale) if scale is not None else None]
+                       for (unit, new_unit), scale
+                       in list(cls._SCALES.items())]
+        }
+        tmp_file = file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(table, f)
+        os.replace(tmp_file, file)
+        cls._UNIT_TABLE_DIRTY = False
+
+    @classmethod
+    def _unit_table_key(cls) -> str:
+        """
+        :return: Key identifying the unit definitions a table was built from.
+        """
+        with open(cls.UNIT_DEFINITIONS, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return '%d:%s' % (cls.UNIT_TABLE_VERSION, digest)
+
     def get_error_or_limit(self, is_limit: bool) -> Tuple[str, str]:
         """
         Get the error/limit tuple:
@@ -120,18 +352,24 @@ class Quantity:
         # conversion not need
         if not (self.error and is_limit != self.is_limit):
             return self.error
+        lower, upper = self._get_dec_error_or_limit(is_limit)
+        return str(lower), str(upper)
+
+    def _get_dec_error_or_limit(self, is_limit: bool) \
+            -> Tuple[Decimal, Decimal]:
+        """
+        Same as get_error_or_limit, but as Decimal numbers.
+        :param is_limit: return limit tuple? otherwise error tuple
+        """
+        if not (self._dec_error and is_limit != self._is_limit):
+            return self._dec_error
+        value, (lower, upper) = self._dec_value, self._dec_error
         if is_limit:
             # convert to limit/bound tuple
-            return (
-                str(Decimal(self.value) - Decimal(self.error[0])),
-                str(Decimal(self.value) + Decimal(self.error[1]))
-            )
+            return value - lower, value + upper
         else:
             # convert to error tuple
-            return (
-                str(Decimal(self.value) - Decimal(self.error[0])),
-                str(Decimal(self.error[1]) - Decimal(self.value))
-            )
+            return value - lower, upper - value
 
     def can_update_error(self, other: 'Quantity') -> bool:
         """
@@ -142,7 +380,7 @@ class Quantity:
         otherwise the return value makes no sense.
         :param other: the other quantity
         """
-        assert self._eq_unit(self.unit, other.unit)
+        assert self._canonical_unit() is other._canonical_unit()
 
         # the new quantity has no error term
         if not other.error:
@@ -152,22 +390,8 @@ class Quantity:
         if not self.error:
             return True
 
-        # they have the same error term
-        if self.error == other.error and self.is_limit == other.is_limit:
-            return False
-
-        # Cannot conclude yet, because
+        # compare the errors as numbers, because
         # 1. ('0.0', '0.0') equals to ('0', '0')
         # 2. need conversion between errors and limits/bounds
-        othererror = other.error
-
-        if self.is_limit != other.is_limit:
-            # conversion between errors and limits
-            othererror = other.get_error_or_limit(self.is_limit)
-
-        # compare the errors
-        for i in range(2):
-            if Decimal(self.error[i]) != Decimal(othererror[i]):
-                return True
-
-        return False
+        othererror = other._get_dec_error_or_limit(self._is_limit)
+        return self._dec_error != othererror
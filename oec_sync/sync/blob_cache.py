@@ -0,0 +1,104 @@
+from typing import Optional
+import hashlib
+import logging
+import os
+import tempfile
+
+
+class BlobCache:
+    """
+    Content-addressed on-disk cache of file contents.
+
+    Every file is stored once, under its git blob SHA. Files that can only
+    be located by an immutable reference, such as the url of a file at a
+    specific commit, are looked up through a ref pointing to the blob.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: Path to the cache directory, created if needed.
+        """
+        self.root = root
+        self.__objects = os.path.join(root, 'objects')
+        self.__refs = os.path.join(root, 'refs')
+        os.makedirs(self.__objects, exist_ok=True)
+        os.makedirs(self.__refs, exist_ok=True)
+
+    @staticmethod
+    def blob_sha(content: bytes) -> str:
+        """
+        Computes the git blob SHA of some content, the same way
+        `git hash-object` does.
+        :param content: File content.
+        :return: Hex digest.
+        """
+        sha = hashlib.sha1(b'blob %d\0' % len(content))
+        sha.update(content)
+        return sha.hexdigest()
+
+    def __object_file(self, blob_sha: str) -> str:
+        return os.path.join(self.__objects, blob_sha[:2], blob_sha[2:])
+
+    def __ref_file(self, ref: str) -> str:
+        digest = hashlib.blake2b(ref.encode('utf-8'), digest_size=20)
+        return os.path.join(self.__refs, digest.hexdigest())
+
+    @staticmethod
+    def __write(file: str, content: bytes) -> None:
+        # write to a temporary file first, so readers never see a partial
+        # file, even with several threads writing the same blob
+        directory = os.path.dirname(file)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+    def get(self, blob_sha: str) -> Optional[bytes]:
+        """
+        :param blob_sha: Git blob SHA of the file.
+        :return: Content of the file, None if it is not cached.
+        """
+        try:
+            with open(self.__object_file(blob_sha), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        if self.blob_sha(content) != blob_sha:
+            logging.warning("Corrupted blob %s in cache" % blob_sha)
+            return None
+        return content
+
+    def put(self, content: bytes) -> str:
+        """
+        Adds a file to the cache.
+        :param content: Content of the file.
+        :return: Git blob SHA of the file.
+        """
+        blob_sha = self.blob_sha(content)
+        if not os.path.isfile(self.__object_file(blob_sha)):
+            self.__write(self.__object_file(blob_sha), content)
+        return blob_sha
+
+    def get_ref(self, ref: str) -> Optional[bytes]:
+        """
+        :param ref: An immutable reference to a file.
+        :return: Content of the file, None if it is not cached.
+        """
+        try:
+            with open(self.__ref_file(ref), 'r') as f:
+                blob_sha = f.read().strip()
+        except OSError:
+            return None
+        return self.get(blob_sha)
+
+    def put_ref(self, ref: str, content: bytes) -> str:
+        """
+        Adds a file to the cache, along with a reference to it.
+        :param ref: An immutable reference to the file.
+        :param content: Content of the file.
+        :return: Git blob SHA of the file.
+        """
+        blob_sha = self.put(content)
+        self.__write(self.__ref_file(ref), blob_sha.encode('ascii'))
+        return blob_sha
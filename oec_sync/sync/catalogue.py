@@ -1,10 +1,19 @@
 import requests
 import csv
-from typing import Any
+from typing import Any, Iterator, Optional, List, Tuple, TextIO, Set, \
+    Callable
+from collections.abc import Mapping
+from contextlib import closing
+from functools import partial
+from operator import itemgetter
 import logging
+import hashlib
+import json
+import re
+import os
+import time
 import yaml
 import oec
-from io import StringIO
 from model import *
 from syncutil import SrcPath
 
@@ -13,6 +22,8 @@ class CatalogueConfig:
     """
     Configuration for a monitored catalogue.
     """
+    # seconds to wait for the server to connect or send data
+    DEFAULT_TIMEOUT = 60
 
     def __init__(self, stream):
         """
@@ -26,6 +37,7 @@ class CatalogueConfig:
         self.name = self.__get_or_fail('name')
 
         self.url = self.__get_or_fail('url')
+        self.timeout = self.raw.get('timeout', CatalogueConfig.DEFAULT_TIMEOUT)
         self.system_name = self.__get_or_fail('system_name')
 
         self.planet_name = self.raw.get('planet_name')
@@ -67,6 +79,208 @@ class CatalogueConfig:
         return value
 
 
+class ColumnProjection:
+    """
+    Positions of the columns a catalogue configuration needs, resolved once
+    from the csv header. Only these columns are kept from each row.
+    """
+    # columns that can be mapped for each monitored field
+    FIELD_KEYS = ('name', 'errorminus', 'errorplus',
+                  'lowerlimit', 'upperlimit', 'limit_flag')
+
+    def __init__(self, config: CatalogueConfig, header: List[str]):
+        """
+        :param config: The catalogue configuration.
+        :param header: Column names in the first row of the csv file.
+        """
+        # later columns win over earlier ones with the same name,
+        # just like csv.DictReader
+        header_idx = {name: idx for idx, name in enumerate(header)}
+        self.indices = []   # header index of each projected column
+        positions = dict()  # header index -> position in projected tuple
+
+        def position(column: str) -> Optional[int]:
+            if not column:
+                return None
+            idx = header_idx.get(column)
+            if idx is None:
+                logging.warning('[%s] Column "%s" not found' %
+                                (config.name, column))
+                return None
+            if idx not in positions:
+                positions[idx] = len(self.indices)
+                self.indices.append(idx)
+            return positions[idx]
+
+        self.system_name = position(config.system_name)
+        if self.system_name is None:
+            raise ValueError('missing system name column "%s"' %
+                             config.system_name)
+        self.planet_name = position(config.planet_name)
+        self.planet_letter = position(config.planet_letter)
+
+        # list of (oec field, unit, tuple of positions in FIELD_KEYS order)
+        self.fields = []
+        for oec_field, cat_fieldmeta in config.field_map.items():
+            self.fields.append((
+                oec_field,
+                cat_fieldmeta.get('unit'),
+                tuple(position(cat_fieldmeta.get(key))
+                      for key in ColumnProjection.FIELD_KEYS)
+            ))
+
+        self.__width = max(self.indices) + 1
+        self.__getter = itemgetter(*self.indices)
+        if len(self.indices) == 1:
+            getter = self.__getter
+            self.__getter = lambda row: (getter(row),)
+
+    def project(self, row: List[str]) -> Tuple[Optional[str], ...]:
+        """
+        Keeps only the required columns of a row.
+        :param row: A row from the csv reader.
+        :return: Tuple of column values, None for missing values.
+        """
+        if len(row) < self.__width:
+            # short row, missing values are treated as empty
+            row = row + [None] * (self.__width - len(row))
+        return self.__getter(row)
+
+
+class CatalogueSnapshot:
+    """
+    The last downloaded copy of a monitored catalogue, stored locally along
+    with the validators needed for conditional requests.
+    """
+    def __init__(self, root: str, name: str):
+        """
+        :param root: Folder holding the snapshots of all catalogues.
+        :param name: Catalogue name.
+        """
+        if not os.path.exists(root):
+            os.makedirs(root)
+        basename = '_'.join(re.split(r'[^\w-]+', name.lower()))
+        self.body_file = os.path.join(root, basename + '.csv')
+        self.meta_file = os.path.join(root, basename + '.json')
+        self.state_file = os.path.join(root, basename + '.state.json')
+
+        self.etag = None
+        self.last_modified = None
+        self.encoding = None
+        self.hash = None
+        try:
+            with open(self.meta_file, 'r') as f:
+                meta = json.load(f)
+            if os.path.isfile(self.body_file):
+                self.etag = meta.get('etag')
+                self.last_modified = meta.get('last_modified')
+                self.encoding = meta.get('encoding')
+                self.hash = meta.get('hash')
+        except (OSError, ValueError):
+            pass    # no usable snapshot yet
+
+    def request_headers(self) -> Dict[str, str]:
+        """
+        :return: Headers that make the request conditional on the catalogue
+        having changed since this snapshot.
+        """
+        headers = dict()
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def update(self, resp: requests.Response) -> bool:
+        """
+        Replaces the snapshot with the body of a response.
+        :param resp: A successful (streamed) response.
+        :return: Whether the content differs from the previous snapshot.
+        """
+        digest = hashlib.sha256()
+        tmp_file = self.body_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            for chunk in resp.iter_content(MonitoredCatalogue.CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_file, self.body_file)
+
+        content_hash = digest.hexdigest()
+        changed = content_hash != self.hash
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        # decode as utf-8 unless the server says otherwise
+        self.encoding = resp.encoding or 'utf-8'
+        self.hash = content_hash
+        with open(self.meta_file, 'w') as f:
+            json.dump({'etag': self.etag,
+                       'last_modified': self.last_modified,
+                       'encoding': self.encoding,
+                       'hash': self.hash}, f)
+        return changed
+
+    def open(self) -> TextIO:
+        """
+        :return: The stored catalogue body, opened for reading.
+        """
+        return open(self.body_file, 'r', encoding=self.encoding or 'utf-8',
+                    newline='')
+
+    def load_state(self) -> Optional[dict]:
+        """
+        :return: The sync state saved along with the snapshot,
+        None if there is none.
+        """
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, state: dict) -> None:
+        """
+        Saves the sync state along with the snapshot.
+        :param state: A json serializable dict.
+        """
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+
+class CatalogueSystems(Mapping):
+    """
+    The systems of a fetched catalogue, by name. A system is only built,
+    with its planets and quantities, the first time it is looked up, so
+    systems that are never compared cost no more than their csv rows.
+    """
+    def __init__(self, rows: Dict[str, List[Tuple[Optional[str], ...]]],
+                 read_system: Callable[[str, List[Tuple]], System]):
+        """
+        :param rows: System name -> projected rows of its planets.
+        :param read_system: Builds a system from its name and rows.
+        """
+        self.__rows = rows
+        self.__read_system = read_system
+        self.__systems = dict()
+
+    def __getitem__(self, name: str) -> System:
+        system = self.__systems.get(name)
+        if system is None:
+            system = self.__read_system(name, self.__rows[name])
+            self.__systems[name] = system
+        return system
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__rows)
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+
 class MonitoredCatalogue:
     """
     # download csv file
@@ -78,95 +292,262 @@ class MonitoredCatalogue:
     The exoplanet data from a monitored catalogue,
     such as NASA Exoplanet Archive
     """
-    def __init__(self, config: CatalogueConfig):
+    # size of the chunks read from the http response
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, config: CatalogueConfig, snapshot_root: str=None):
         """
         :param config: The configuration for this monitored catalogue.
+        :param snapshot_root: Folder to keep the last downloaded copy of the
+        catalogue in. If None, the catalogue is downloaded on every fetch.
         """
         self.config = config
-        self.systems = None  # dict of System
-
-    def fetch(self) -> None:
+        self.systems = None  # CatalogueSystems
+        self.snapshot = None
+        if snapshot_root:
+            self.snapshot = CatalogueSnapshot(snapshot_root, config.name)
+
+        # names of the systems whose rows were added, changed or removed
+        # since the last commit, None if there is nothing to compare with
+        self.changed_systems = None     # type: Optional[Set[str]]
+        # OEC commit the catalogue was last synced against
+        self.synced_oec_head = None     # type: Optional[str]
+        # time of the last sync that compared every system
+        self.last_full_sync = 0.0
+
+        # system name -> frozenset of row hashes, of the current fetch and
+        # of the last commit
+        self.__row_hashes = dict()
+        self.__synced_hashes = None
+        state = self.snapshot.load_state() if self.snapshot else None
+        if state:
+            self.__synced_hashes = {name: frozenset(hashes) for name, hashes
+                                    in state.get('rows', {}).items()}
+            self.synced_oec_head = state.get('oec_head')
+            self.last_full_sync = state.get('last_full_sync', 0.0)
+
+    def fetch(self) -> bool:
         """
-        Fetch the latest csv from monitored catalogue
+        Fetch the latest csv from monitored catalogue.
+        The csv is read as a stream, and only the mapped columns are kept.
+        changed_systems is updated as well.
+        :return: Whether the systems were rebuilt. False if the catalogue
+        has not changed since the last fetch.
         """
-        reader = None
-
+        try:
+            rebuilt = self._fetch()
+        except Exception:
+            # the systems may be half built, read them again next time
+            self.systems = None
+            raise
+        self._diff_rows()
+        return rebuilt
+
+    def commit(self, oec_head: str=None, full: bool=False) -> None:
+        """
+        Marks the fetched rows as synced, so the next fetch only reports
+        systems changed after this point.
+        :param oec_head: The OEC commit the catalogue was synced against.
+        :param full: Whether every system was compared in this sync.
+        """
+        self.__synced_hashes = dict(self.__row_hashes)
+        self.synced_oec_head = oec_head
+        if full:
+            self.last_full_sync = time.time()
+        self.changed_systems = set()
+        if self.snapshot is None:
+            return
+        try:
+            self.snapshot.save_state({
+                'rows': {name: sorted(hashes) for name, hashes
+                         in self.__synced_hashes.items()},
+                'oec_head': self.synced_oec_head,
+                'last_full_sync': self.last_full_sync
+            })
+        except OSError as e:
+            logging.warning("[%s] Unable to save sync state: %s" %
+                            (self.config.name, e))
+
+    def _fetch(self) -> bool:
         # debug feature - load file locally
         debug_file = self.config.raw.get('debug_file')
         if debug_file:
             debug_file = SrcPath.abs(debug_file)
-            with open(debug_file, 'r') as f:
-                # read the entire file so we can close it right away
-                reader = csv.DictReader(StringIO(f.read()))
+            with open(debug_file, 'r', newline='') as f:
+                self._read_csv(csv.reader(f))
                 logging.debug("Loaded catalogue from local debug file")
+            return True
+
+        if self.snapshot is None:
+            with closing(requests.get(self.config.url, stream=True,
+                                      timeout=self.config.timeout)) as resp:
+                resp.raise_for_status()
+                resp.encoding = resp.encoding or 'utf-8'
+                chunks = resp.iter_content(MonitoredCatalogue.CHUNK_SIZE,
+                                           decode_unicode=True)
+                self._read_csv(csv.reader(self._iter_lines(chunks)))
+            return True
+
+        # only download the catalogue if it has changed
+        with closing(requests.get(self.config.url,
+                                  headers=self.snapshot.request_headers(),
+                                  stream=True,
+                                  timeout=self.config.timeout)) as resp:
+            if resp.status_code == 304:
+                logging.info("[%s] Not modified" % self.config.name)
+                changed = False
+            else:
+                resp.raise_for_status()
+                changed = self.snapshot.update(resp)
+                if not changed:
+                    logging.info("[%s] Content unchanged" % self.config.name)
 
-        if not reader:
-            f = requests.get(self.config.url)
-            result = f.text
-            reader = csv.DictReader(StringIO(result))
-
-        # search the index of required field in raw field list
-        # self._search_index(raw_col)
-        # loop through each row in the csv
+        if not changed and self.systems is not None:
+            return False
 
-        self.systems = dict()
+        with self.snapshot.open() as f:
+            self._read_csv(csv.reader(f))
+        return True
 
-        def try_get_field(row: Dict[str, str], fielddesc: Dict[str, str],
-                          oec_field_name: str):
-            cat_field_name = fielddesc.get(oec_field_name)
-            if cat_field_name:
-                row_value = row.get(cat_field_name)
-                return row_value
+    @staticmethod
+    def _iter_lines(chunks: Iterator[str]) -> Iterator[str]:
+        """
+        Splits a stream of text into lines, keeping the line endings so
+        the csv reader can handle quoted line breaks.
+        :param chunks: Chunks of text.
+        :return: Generator of lines.
+        """
+        pending = ''
+        for chunk in chunks:
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+    def _read_csv(self, reader: Iterator[List[str]]) -> None:
+        """
+        Builds the systems from rows of the csv file.
+        :param reader: csv reader, the first row must be the header.
+        """
+        self.systems = CatalogueSystems(dict(), None)
+        self.__row_hashes = dict()
+        header = next(reader, None)
+        if header is None:
+            logging.warning('[%s] Empty catalogue' % self.config.name)
+            return
+
+        projection = ColumnProjection(self.config, header)
+        rows = dict()           # system name -> projected rows
+        row_hashes = dict()     # system name -> set of row hashes
+        for row in reader:
+            if not row:
+                # blank line, csv.DictReader used to skip these
+                continue
+            row = projection.project(row)
+            system_name = row[projection.system_name]
+            if not system_name:
+                continue
+            rows.setdefault(system_name, []).append(row)
+            row_hashes.setdefault(system_name, set()).add(self._hash_row(row))
+        self.systems = CatalogueSystems(
+                rows, partial(self._read_system, projection))
+        self.__row_hashes = {name: frozenset(hashes)
+                             for name, hashes in row_hashes.items()}
+
+    @staticmethod
+    def _hash_row(row: Tuple[Optional[str], ...]) -> str:
+        """
+        :param row: Projected row.
+        :return: Short digest of the row.
+        """
+        content = '\x1f'.join(value or '' for value in row)
+        return hashlib.blake2b(content.encode('utf-8'),
+                               digest_size=8).hexdigest()
 
-        for next_planet in reader:
-            system_name = next_planet[self.config.system_name]
+    def _diff_rows(self) -> None:
+        """
+        Finds the systems whose rows changed since the last commit.
+        """
+        if self.__synced_hashes is None:
+            self.changed_systems = None
+            return
+        current, synced = self.__row_hashes, self.__synced_hashes
+        self.changed_systems = {
+            name for name in current.keys() | synced.keys()
+            if current.get(name) != synced.get(name)}
+        logging.info("[%s] %d system(s) changed since the last sync" %
+                     (self.config.name, len(self.changed_systems)))
+
+    @staticmethod
+    def _read_system(projection: ColumnProjection, system_name: str,
+                     rows: List[Tuple[Optional[str], ...]]) -> System:
+        """
+        Builds a system from its rows.
+        :param projection: Positions of the columns in the rows.
+        :param system_name: System name.
+        :param rows: Projected rows of the planets in the system.
+        :return: The system.
+        """
+        system = System(system_name)
+        for row in rows:
+            system.planets.append(
+                    MonitoredCatalogue._read_planet(projection, row))
+        return system
+
+    @staticmethod
+    def _read_planet(projection: ColumnProjection,
+                     row: Tuple[Optional[str], ...]) -> Planet:
+        """
+        Builds the planet in a projected row.
+        :param projection: Positions of the columns in the row.
+        :param row: Projected row.
+        :return: The planet.
+        """
+        system_name = row[projection.system_name]
+
+        if projection.planet_name is not None:
+            planet_name = row[projection.planet_name]
+        else:
+            planet_name = system_name + ' ' + \
+                          (row[projection.planet_letter]
+                           if projection.planet_letter is not None else '')
+
+        pl = Planet(planet_name, system_name)
+
+        def get(pos: Optional[int]) -> Optional[str]:
+            return row[pos] if pos is not None else None
+
+        for oec_field, unit, positions in projection.fields:
+            value_pos, errorminus_pos, errorplus_pos, \
+                lowerlimit_pos, upperlimit_pos, limitflag_pos = positions
+            value = get(value_pos)
+            if value:
+                lowerlimit = get(lowerlimit_pos)
+                upperlimit = get(upperlimit_pos)
+                limitflag = get(limitflag_pos)
+
+                explicit_limit = lowerlimit or upperlimit
+
+                errors = (lowerlimit, upperlimit)\
+                    if explicit_limit else (get(errorminus_pos),
+                                            get(errorplus_pos))
+
+                q = Quantity(
+                    value,
+                    unit,
+                    errors,
+                    bool(explicit_limit or (limitflag is None and
+                                            bool(limitflag)))
+                )
 
-            planet_name = None
-            if self.config.planet_name:
-                planet_name = next_planet[self.config.planet_name]
-            else:
-                planet_name = system_name + ' ' +\
-                              next_planet[self.config.planet_letter]
-
-            pl = Planet(planet_name, system_name)
-
-            for oec_field, cat_fieldmeta in self.config.field_map.items():
-                value = next_planet.get(cat_fieldmeta['name'])
-                if value:
-                    errorminus = try_get_field(next_planet,
-                                               cat_fieldmeta, 'errorminus')
-                    errorplus = try_get_field(next_planet,
-                                              cat_fieldmeta, 'errorplus')
-                    lowerlimit = try_get_field(next_planet,
-                                               cat_fieldmeta, 'lowerlimit')
-                    upperlimit = try_get_field(next_planet,
-                                               cat_fieldmeta, 'upperlimit')
-                    limitflag = try_get_field(next_planet,
-                                              cat_fieldmeta, 'limit_flag')
-
-                    explicit_limit = lowerlimit or upperlimit
-
-                    errors = (lowerlimit, upperlimit)\
-                        if explicit_limit else (errorminus, errorplus)
-
-                    q = Quantity(
-                        value,
-                        cat_fieldmeta.get('unit'),
-                        errors,
-                        bool(explicit_limit or (limitflag is None and
-                                                bool(limitflag)))
-                    )
-
-                    # convert the quantity if it's using different unit
-                    oec_fieldmeta = oec.PLANET_FIELDS[oec_field]
-                    if oec_fieldmeta.unit != cat_fieldmeta.get('unit'):
-                        q = q.to(oec_fieldmeta.unit)
-                    pl.prop[oec_field] = q
-
-            sys = self.systems.get(system_name)
-            if sys is None:
-                self.systems[system_name] = sys = System(system_name)
-            sys.planets.append(pl)
+                # convert the quantity if it's using different unit
+                oec_fieldmeta = oec.PLANET_FIELDS[oec_field]
+                if oec_fieldmeta.unit != unit:
+                    q = q.to(oec_fieldmeta.unit)
+                pl.prop[oec_field] = q
+        return pl
 
     def _value_convert(self):
         pass
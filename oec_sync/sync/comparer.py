@@ -14,8 +14,11 @@ def data_compare(old_sys: System, new_sys: System) \
         update_sys = PlanetarySysUpdate(old_sys.name, False, [])
         # loop through list of planets
         for new_pl in new_sys.planets:
-            if new_pl in old_sys.planets:
-                old_pl = old_sys.planets[old_sys.planets.index(new_pl)]
+            old_pl = old_sys.find_planet(new_pl)
+            if old_pl is not None:
+                if new_pl.fingerprint() <= old_pl.fingerprint():
+                    # same values and errors on every field
+                    continue
                 update_planet = PlanetUpdate(old_pl.name, False, {})
                 # loop through fields in the newer planet
                 for field, new_value in new_pl.prop.items():
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 from astro_unit import Quantity
-from typing import List, Dict, Set
+from typing import Any, List, Dict, Set, Optional
+from decimal import Decimal
+from operator import itemgetter
+import hashlib
 import re
 
 
@@ -75,6 +78,19 @@ class Planet(Body):
     def __eq__(self, other: 'Planet'):
         return Body.__eq__(self, other) and self.system == other.system
 
+    def fingerprint(self) -> frozenset:
+        """
+        Returns the canonical form of the planet properties. If the
+        fingerprint of a planet is a subset of the fingerprint of another
+        planet, it has nothing to update on the other planet.
+        Quantities keep their own fingerprints, so this only collects them.
+        :return: Set of tuples (field, canonical value).
+        """
+        return frozenset(
+            (field, value.fingerprint()
+             if isinstance(value, Quantity) else value)
+            for field, value in self.prop.items())
+
 
 class System(Body):
     """
@@ -101,12 +117,50 @@ class System(Body):
         super().__init__(name, all_names, prop)
         self.planets = planets
         self.file = file
+        # sanitized name -> positions of the planets, built on first lookup
+        # and dropped whenever update_planets changes the planets
+        self._planet_index = None
 
     def __repr__(self):
         return "System(%(name)r, %(file)r, " \
                "%(planets)r, %(all_names)r, %(prop)r)" % \
                self.__dict__
 
+    def __getstate__(self):
+        # the planet index is rebuilt on demand, don't pickle it
+        state = self.__dict__.copy()
+        state['_planet_index'] = None
+        return state
+
+    def find_planet(self, planet: Planet) -> Optional[Planet]:
+        """
+        Finds the first planet of this system that equals the given planet,
+        the same one `self.planets.index(planet)` would find.
+        :param planet: A planet, usually from another catalogue.
+        :return: The matching planet, or None if there is none.
+        """
+        index = self._planet_index
+        if index is None:
+            index = self._planet_index = self.__index_planets()
+        positions = set()
+        for name in planet.all_names:
+            positions.update(index.get(name, ()))
+        for pos in sorted(positions):
+            if planet == self.planets[pos]:
+                return self.planets[pos]
+        return None
+
+    def __index_planets(self) -> Dict[str, List[int]]:
+        """
+        Indexes the planets by their sanitized names.
+        :return: Dict of sanitized name -> positions of the planets.
+        """
+        index = dict()
+        for pos, pl in enumerate(self.planets):
+            for name in pl.all_names:
+                index.setdefault(name, []).append(pos)
+        return index
+
     def update_planets(self, new_planet: Planet, old_planet: Planet=None):
         """
         Removes all old_planet by name, if any, and
@@ -120,6 +174,7 @@ class System(Body):
                 if planet.name == old_planet.name:
                     self.planets.pop(index)
         self.planets.append(new_planet)
+        self._planet_index = None
 
 
 class BodyUpdate(ABC):
@@ -149,11 +204,51 @@ class PlanetUpdate(BodyUpdate):
         return "PlanetUpdate(%(name)r, %(new)r, %(fields)r)" % \
             self.__dict__
 
+    def canonical(self) -> tuple:
+        """
+        Quantities keep their own fingerprints, so this only collects them.
+        :return: The content of this update, with fields sorted by name and
+        quantities in their canonical form.
+        """
+        return (self.name, self.new,
+                tuple((field, self.__canonical_value(value))
+                      for field, value in sorted(self.fields.items(),
+                                                 key=itemgetter(0))))
+
+    @staticmethod
+    def __canonical_value(value: Any) -> Any:
+        if isinstance(value, Quantity):
+            return value.fingerprint()
+        return value
+
+    @staticmethod
+    def serialize(canonical: tuple) -> bytes:
+        """
+        Serializes the canonical form of a planet update, writing numbers
+        without trailing zeros so '0.0' and '0' are the same.
+        :param canonical: Result of canonical().
+        """
+        def text(o: Any) -> str:
+            if isinstance(o, Decimal):
+                return str(o.normalize())
+            if isinstance(o, tuple):
+                return '(' + '\x1e'.join(map(text, o)) + ')'
+            return repr(o)
+
+        name, new, fields = canonical
+        parts = [repr(name), repr(new)]
+        for field, value in fields:
+            parts.append(field + '=' + text(value))
+        return '\x1f'.join(parts).encode('utf-8')
+
 
 class PlanetarySysUpdate(BodyUpdate):
     """
     Representation of all changes to planets inside the same planetary system.
     """
+    # (name, new, canonical form of every planet update, digest)
+    _digest = None
+
     def __init__(self, name: str, new: bool=False,
                  planets: List[PlanetUpdate]=None):
         super().__init__(name, new)
@@ -163,6 +258,42 @@ class PlanetarySysUpdate(BodyUpdate):
         return "PlanetarySysUpdate(%(name)r, %(new)r, %(planets)r)" % \
             self.__dict__
 
+    def __getstate__(self):
+        # the digest is computed again on demand, don't pickle it
+        state = self.__dict__.copy()
+        state.pop('_digest', None)
+        return state
+
+    def __setstate__(self, state):
+        # older versions pickled the digest in another form
+        state.pop('_digest', None)
+        self.__dict__.update(state)
+
+    def digest(self) -> str:
+        """
+        Computes a digest of the content of this update. Updates with the
+        same planets and fields have the same digest, regardless of their
+        order or of how the numbers are written.
+        The digest is kept until the content changes.
+        :return: Hex digest.
+        """
+        planets = tuple(planet.canonical() for planet in self.planets)
+        memo = self._digest
+        # unchanged quantities hand out the very same fingerprint, so
+        # comparing an unchanged update mostly compares identities
+        if memo is not None and memo[0] == self.name and \
+                memo[1] == self.new and memo[2] == planets:
+            return memo[3]
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((self.name, self.new)).encode('utf-8'))
+        for planet in sorted(map(PlanetUpdate.serialize, planets)):
+            h.update(b'\x1d')
+            h.update(planet)
+        digest = h.hexdigest()
+        self._digest = (self.name, self.new, planets, digest)
+        return digest
+
     def add_update(self, new_update: PlanetUpdate):
         """
         Adds new planet update to this planetary system update.
@@ -170,3 +301,4 @@ class PlanetarySysUpdate(BodyUpdate):
         :return: None
         """
         self.planets.append(new_update)
+        self._digest = None
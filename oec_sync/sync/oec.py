@@ -2,7 +2,9 @@ from xml.etree import ElementTree as Etree
 from model import *
 from astro_unit import *
 from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import pickle
 
 
 class FieldMeta:
@@ -56,10 +58,24 @@ PLANET_FIELDS = {
 }
 
 
+def _read_system_batch(files: List[str]) -> bytes:
+    """
+    Reads out a batch of system files in a worker process.
+    :param files: Paths to system xml files.
+    :return: The pickled list of systems.
+    """
+    adapter = Adapter()
+    return pickle.dumps([adapter.read_system(file) for file in files],
+                        pickle.HIGHEST_PROTOCOL)
+
+
 class Adapter:
     """
     Reads/writes OEC files.
     """
+    # number of batches of system files handed to each worker process
+    BATCHES_PER_WORKER = 4
+
     def __init__(self, schema_file: str=None):
         """
         :param schema_file: Schema file (*.xsd)
@@ -140,6 +156,29 @@ class Adapter:
             system.planets.append(planet)
         return system
 
+    def read_systems(self, files: List[str], workers: int=1) -> List[System]:
+        """
+        Reads out many system files.
+        :param files: Paths to system xml files.
+        :param workers: Number of processes parsing the files in parallel.
+        :return: The systems, in the same order as the files.
+        """
+        if workers <= 1 or len(files) < 2:
+            return [self.read_system(file) for file in files]
+
+        # a few batches per worker evens out the uneven file sizes, while
+        # keeping the number of round trips to the workers small
+        batch_size = -(-len(files) // (workers * Adapter.BATCHES_PER_WORKER))
+        batches = [files[i:i + batch_size]
+                   for i in range(0, len(files), batch_size)]
+
+        systems = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # map() yields the results in the order of the batches
+            for serialized in pool.map(_read_system_batch, batches):
+                systems.extend(pickle.loads(serialized))
+        return systems
+
     @staticmethod
     def _write_number(field: Etree.Element, number: Quantity) -> bool:
         # attrib is a dictionary holding the attributes of this element
@@ -162,30 +201,141 @@ class Adapter:
                 attrib['errorminus'], attrib['errorplus'] = number.error
         return True
 
-    @staticmethod
-    def _write_planet_update(planet: Etree.Element, update: PlanetUpdate) \
+    # def validate(self, file: str) -> None:
+    #     Validates an xml using schema defined by OEC.
+    #     Raises an exception if file does not follow the schema.
+    #     :param file: File name.
+    #     """
+    #     return  # skip for now, because OEC itself isn't following the schema
+    #     # tree = etree.parse(file)
+    #     # self._schema.assertValid(tree)
+
+    def parse_str(self, xml_string: str) -> 'SystemDocument':
+        """
+        Parses a system for editing.
+        :param xml_string: containing the xml representation of a system
+        :return: The parsed system, reusable across edits.
+        """
+        return SystemDocument(Etree.parse(StringIO(xml_string)))
+
+    def parse_file(self, filename: str) -> 'SystemDocument':
+        """
+        Parses a system file for editing.
+        :param filename: The system xml file
+        :return: The parsed system, reusable across edits.
+        """
+        return SystemDocument(Etree.parse(filename))
+
+    def update_str(self, xml_string: str, update: PlanetarySysUpdate) \
+            -> Tuple[str, bool]:
+        """
+        Apply a system update to an xml string.
+        Also performs a check afterwards to determine if
+        the action succeeded.
+        :param xml_string: containing the xml representation of a system
+        :param update: Update to be applied to the system
+        :return: A tuple (content, succeeded) where:
+            - content is the file content modified
+            - succeeded indicates whether the update was successful.
+        """
+        return self.update_str_many(xml_string, [update])
+
+    def update_str_many(self, xml_string: str,
+                        updates: List[PlanetarySysUpdate]) \
+            -> Tuple[str, bool]:
+        """
+        Apply several updates of the same system to an xml string, parsing
+        and serializing it only once.
+        :param xml_string: containing the xml representation of a system
+        :param updates: Updates to be applied to the system, in order
+        :return: A tuple (content, succeeded) where:
+            - content is the file content modified
+            - succeeded indicates whether all updates were successful.
+        """
+        document = self.parse_str(xml_string)
+        ok = document.apply_all(updates)
+        return document.to_str(), ok
+
+    def update_file(self, filename: str, update: PlanetarySysUpdate) -> bool:
+        """
+        Apply a system update to an xml file.
+        :param filename: The system xml file
+        :param update: Update to be applied to the system
+        :return: Whether the update was successful
+        """
+        document = self.parse_file(filename)
+        succeeded = document.apply(update)
+        document.write(filename)
+        return succeeded
+
+
+class SystemDocument:
+    """
+    A parsed system file being edited.
+
+    Planets are indexed by all of their names, and their fields by tag, the
+    first time they are needed, so any number of updates can be applied
+    without searching the tree again. Edits accumulate in the tree until it
+    is serialized.
+    """
+    def __init__(self, tree: Etree.ElementTree):
+        """
+        :param tree: Parsed system file.
+        """
+        self.tree = tree
+        self.__planets = None   # planet name -> planet element
+        self.__fields = dict()  # planet element -> (field tag -> element)
+
+    def planet(self, name: str) -> Optional[Etree.Element]:
+        """
+        Finds a planet element by any of its names.
+        :param name: Planet name.
+        :return: The first planet with that name, None if there is none.
+        """
+        if self.__planets is None:
+            self.__planets = dict()
+            for planet in self.tree.getroot().iter('planet'):
+                for name_elem in planet.iterfind('name'):
+                    self.__planets.setdefault(name_elem.text, planet)
+        return self.__planets.get(name)
+
+    def __field(self, planet: Etree.Element, tag: str) -> Etree.Element:
+        """
+        Finds a field of a planet, creating it if it does not exist.
+        """
+        fields = self.__fields.get(planet)
+        if fields is None:
+            fields = dict()
+            for child in planet:
+                fields.setdefault(child.tag, child)
+            self.__fields[planet] = fields
+        field = fields.get(tag)
+        if field is None:
+            # the original planet does not have this field
+            logging.debug("Creating new field '%s'" % tag)
+            field = fields[tag] = Etree.SubElement(planet, tag)
+        return field
+
+    def _apply_planet(self, planet: Etree.Element, update: PlanetUpdate) \
             -> bool:
         succeeded = True
         # loop through new values in the update objects
         for field, new_value in update.fields.items():
             try:
-                prop_elem = planet.find(field)
-                if prop_elem is None:
-                    # the original planet does not have this field
-                    logging.debug("Creating new field '%s'" % field)
-                    # create the field under the planet
-                    prop_elem = Etree.SubElement(planet, field)
-
                 # write the new value
-                succeeded &= Adapter._write_number(prop_elem, new_value)
+                succeeded &= Adapter._write_number(
+                        self.__field(planet, field), new_value)
             except Exception as e:
                 logging.exception(e)
                 succeeded = False
         return succeeded
 
-    @staticmethod
-    def _write_system_update(root: Etree.Element,
-                             update: PlanetarySysUpdate) -> bool:
+    def apply(self, update: PlanetarySysUpdate) -> bool:
+        """
+        Applies a system update to the tree.
+        :param update: Update to be applied to the system
+        :return: Whether the update was successful
+        """
         if update.new:
             # a new system?
             raise NotImplementedError
@@ -197,13 +347,10 @@ class Adapter:
                 logging.debug('Skipped new planet update %r' % planet_update)
                 continue
 
-            # find planet element with the name
-            planet_elem = root.find('.//planet[name="%s"]' %
-                                    planet_update.name)
-
             # planet does not exist in the file?
             # creating a new planet isn't as easy,
             # need some info about the host star.
+            planet_elem = self.planet(planet_update.name)
             if planet_elem is None:
                 succeeded = False
                 logging.debug('Could not find planet <%s>' %
@@ -213,44 +360,29 @@ class Adapter:
             # apply the update to the current planet
             logging.debug('Updating planet <%s>...' %
                           planet_update.name)
-            succeeded &= Adapter._write_planet_update(
-                    planet_elem,
-                    planet_update)
+            succeeded &= self._apply_planet(planet_elem, planet_update)
         return succeeded
-    # def validate(self, file: str) -> None:
-    #     Validates an xml using schema defined by OEC.
-    #     Raises an exception if file does not follow the schema.
-    #     :param file: File name.
-    #     """
-    #     return  # skip for now, because OEC itself isn't following the schema
-    #     # tree = etree.parse(file)
-    #     # self._schema.assertValid(tree)
 
-    def update_str(self, xml_string: str, update: PlanetarySysUpdate) \
-            -> Tuple[str, bool]:
+    def apply_all(self, updates: List[PlanetarySysUpdate]) -> bool:
         """
-        Apply a system update to an xml string.
-        Also performs a check afterwards to determine if
-        the action succeeded.
-        :param xml_string: containing the xml representation of a system
-        :param update: Update to be applied to the system
-        :return: A tuple (content, succeeded) where:
-            - content is the file content modified
-            - succeeded indicates whether the update was successful.
+        Applies several system updates to the tree, in order.
+        :param updates: Updates to be applied to the system
+        :return: Whether all updates were successful
         """
-        tree = Etree.parse(StringIO(xml_string))
-        ok = Adapter._write_system_update(tree, update)
-        serialized = Etree.tostring(tree.getroot(), 'unicode', 'xml')
-        return serialized, ok
+        succeeded = True
+        for update in updates:
+            succeeded &= self.apply(update)
+        return succeeded
 
-    def update_file(self, filename: str, update: PlanetarySysUpdate) -> bool:
+    def to_str(self) -> str:
         """
-        Apply a system update to an xml file.
+        :return: The xml representation of the system, with all edits.
+        """
+        return Etree.tostring(self.tree.getroot(), 'unicode', 'xml')
+
+    def write(self, filename: str) -> None:
+        """
+        Writes the system, with all edits, to a file.
         :param filename: The system xml file
-        :param update: Update to be applied to the system
-        :return: Whether the update was successful
         """
-        tree = Etree.parse(filename)
-        succeeded = Adapter._write_system_update(tree, update)
-        tree.write(filename)
-        return succeeded
+        self.tree.write(filename)
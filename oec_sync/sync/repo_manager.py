@@ -1,11 +1,18 @@
 from os import path, chmod
 from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dulwich import porcelain, errors
-from typing import Callable
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Optional
 import urllib
 import logging
 import git
+import os
+import queue
 import stat
+import tempfile
+import threading
+import time
 '''
 Using porcelain and git. Due to memory leak, this should be used in a
 separate thread that only runs for as long as needed for the initialization
@@ -13,31 +20,82 @@ separate thread that only runs for as long as needed for the initialization
 '''
 
 
+class FileChange:
+    """
+    A file changed between two commits.
+    """
+    def __init__(self, change_type: str, old_path: Optional[str],
+                 new_path: Optional[str], new_blob: Optional[str]):
+        """
+        :param change_type: One of git's change types, e.g. 'A', 'D', 'M', 'R'
+        :param old_path: Path before the change, None if the file is added.
+        :param new_path: Path after the change, None if the file is deleted.
+        :param new_blob: Blob SHA after the change, None if the file is deleted
+        """
+        self.change_type = change_type
+        self.old_path = old_path
+        self.new_path = new_path
+        self.new_blob = new_blob
+
+    def __repr__(self):
+        return "FileChange(%(change_type)r, %(old_path)r, " \
+               "%(new_path)r, %(new_blob)r)" % self.__dict__
+
+
 class RepoManager:
     """
     Manages a local copy of OEC repository.
     """
     REPO_BANNER = "OEC_SYNC REPOSITORY"
 
-    def __init__(self, root: str, repository: str):
+    # default number of linked worktrees leased to concurrent submissions
+    WORKTREES = 4
+    # directory of the linked worktrees, inside the git directory so they
+    # never show up in the main working tree
+    WORKTREE_DIR = 'sync-worktrees'
+    # file in the git directory touched whenever the branches are pruned
+    PRUNE_STAMP = 'sync-pruned'
+
+    def __init__(self, root: str, repository: str,
+                 sparse_paths: List[str]=None, depth: int=None,
+                 worktrees: int=WORKTREES):
         """
         Initialize the manager for local OEC git repository.
         :type repository: str
         :param root: Path to the local repository.
         :param repository: Git clone path.
+        :param sparse_paths: Only check out these directories (relative to
+        the repository root). Everything is checked out if None.
+        :param depth: Only clone and pull this many commits of history, and
+        fetch file contents on demand. The full history if None.
+        :param worktrees: Maximum number of linked worktrees, i.e. of
+        branches built at the same time.
         """
         logging.info("__init__: Execution started")
         self.oec = None
         self.root = ""
+        self.sparse_paths = sparse_paths
+        self.depth = depth
+        self.worktrees = max(1, worktrees or 1)
         self.__remote = None
         self.__destroyed = True
+        # git object reads share one `git cat-file` process per repository
+        self.__object_lock = threading.Lock()
+        # branch name -> head, rebuilt when the refs change on disk
+        self.__ref_lock = threading.RLock()
+        self.__branch_index = None
+        self.__branch_index_key = None
+        # idle linked worktrees, created on demand up to self.worktrees
+        self.__worktree_lock = threading.Lock()
+        self.__worktree_pool = queue.LifoQueue()
+        self.__worktree_count = 0
         # convert ssh path to http and verify. Path verification is left to OS
         if repository[0:4] == 'git@':
             parts = repository.split(sep=":")
             repository = "https://github.com/" + parts[1]
         else:
             parsed_url = urllib.parse.urlparse(repository)
-            if (parsed_url.scheme != "https" or
+            if (parsed_url.scheme not in ("https", "file") or
                     parsed_url.path[-4:] != '.git'):
                 logging.error("Invalid repository URL")
                 logging.info("__init__: Execution terminated")
@@ -83,7 +141,7 @@ class RepoManager:
         # clone repository to file system and set fields
         try:
             # clone the oec repo
-            self.oec = git.Repo.clone_from(repository, root)
+            self.oec = self.__clone(repository, root)
             # create a reference for remote ops like push pull etc
             self.__remote = self.oec.remote('origin')
             self.root = root
@@ -103,6 +161,29 @@ class RepoManager:
         logging.info("__init__: Execution terminated")
         return
 
+    def __clone(self, repository: str, root: str) -> git.Repo:
+        """
+        Clones the repository, as shallow and sparse as configured.
+        """
+        if not self.depth and not self.sparse_paths:
+            return git.Repo.clone_from(repository, root)
+
+        options = dict(branch='master', no_checkout=True)
+        if self.depth:
+            options.update(depth=self.depth, filter='blob:none')
+        repo = git.Repo.clone_from(repository, root, **options)
+        if self.sparse_paths:
+            # the sparse checkout file understood by every git version,
+            # rather than the newer `git sparse-checkout` command
+            repo.git.config('core.sparseCheckout', 'true')
+            info_dir = path.join(repo.git_dir, 'info')
+            os.makedirs(info_dir, exist_ok=True)
+            with open(path.join(info_dir, 'sparse-checkout'), 'w') as f:
+                for sparse_path in self.sparse_paths:
+                    f.write('/%s/\n' % sparse_path.strip('/'))
+        repo.git.read_tree('-mu', 'HEAD')
+        return repo
+
     def checkout(self, branch_name: str='master') -> bool:
         """
         Checks out the specified branch.
@@ -112,14 +193,12 @@ class RepoManager:
         checkout_success = False
         if self.__destroyed is not True:
             try:
-                for indx in range(0, len(self.oec.branches)):
-                    if self.oec.branches[indx].name == branch_name:
-                        found_idx = indx
-                        self.oec.refs[found_idx].checkout()
-                        logging.info("Checkout successful")
-                        checkout_success = True
-                        break
-                if not checkout_success:
+                head = self.find_branch(branch_name)
+                if head is not None:
+                    head.checkout()
+                    logging.info("Checkout successful")
+                    checkout_success = True
+                else:
                     logging.warning("No such branch '"
                                     + branch_name + "' exists")
             except git.exc.GitCommandError as e:
@@ -128,6 +207,138 @@ class RepoManager:
         logging.info("checkout: Execution terminated")
         return checkout_success
 
+    def __branch_index_state(self) -> tuple:
+        """
+        :return: Modification times of the ref storage, they change whenever
+        a branch is created or deleted.
+        """
+        state = []
+        for ref_file in ('refs/heads', 'packed-refs'):
+            try:
+                state.append(os.stat(path.join(self.oec.git_dir,
+                                               ref_file)).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def __branches(self) -> Dict[str, git.Head]:
+        """
+        :return: Dict of branch name -> head, of all local branches.
+        """
+        with self.__ref_lock:
+            state = self.__branch_index_state()
+            if self.__branch_index is None or \
+                    state != self.__branch_index_key:
+                self.__branch_index = {head.name: head
+                                       for head in self.oec.heads}
+                self.__branch_index_key = state
+            return self.__branch_index
+
+    def __change_branches(self, change: Callable[[], Any],
+                          added: List[str]=(), removed: List[str]=()) -> Any:
+        """
+        Creates or deletes branches, keeping the index up-to-date without
+        rebuilding it, unless the refs had also changed by other means.
+        :param change: Function making the change.
+        :param added: Names of the branches created by the change.
+        :param removed: Names of the branches deleted by the change.
+        :return: Whatever change returns.
+        """
+        with self.__ref_lock:
+            fresh = self.__branch_index is not None and \
+                self.__branch_index_state() == self.__branch_index_key
+            try:
+                result = change()
+            except Exception:
+                self.__branch_index = None
+                raise
+            if fresh:
+                for name in removed:
+                    self.__branch_index.pop(name, None)
+                for name in added:
+                    self.__branch_index[name] = \
+                        git.Head(self.oec, 'refs/heads/' + name)
+                self.__branch_index_key = self.__branch_index_state()
+            else:
+                self.__branch_index = None
+            return result
+
+    def __delete_heads(self, names: List[str]) -> None:
+        """
+        Deletes local branches with a single git command.
+        """
+        if names:
+            self.__change_branches(
+                lambda: self.oec.git.branch('-D', *names), removed=names)
+
+    def find_branch(self, name: str) -> Optional[git.Head]:
+        """
+        Looks up a local branch.
+        :param name: Branch name.
+        :return: The branch, None if it does not exist.
+        """
+        if self.__destroyed is True:
+            return None
+        return self.__branches().get(name)
+
+    def prune_branches(self, interval: float=0) -> int:
+        """
+        Deletes the local branches that are merged into master, or have
+        been pushed as they are. Master and the current branch are kept.
+        :param interval: Seconds to wait since the last prune, nothing is
+        done if the branches were pruned more recently.
+        :return: Number of branches deleted.
+        """
+        logging.info("prune_branches: Execution started")
+        pruned = []
+        if self.__destroyed is not True and self.__prune_due(interval):
+            keep = {"master"}
+            if not self.oec.head.is_detached:
+                keep.add(self.oec.head.ref.name)
+            pushed = dict()     # branch name -> commit hash on remote
+            try:
+                for line in self.oec.git.ls_remote('--heads',
+                                                   'origin').splitlines():
+                    sha, ref = line.split('\t', 1)
+                    pushed[ref[len('refs/heads/'):]] = sha
+            except git.exc.GitCommandError as e:
+                logging.warning("Unable to list remote branches: %s" % e)
+            try:
+                # lines look like '* master' or '+ branch' (in a worktree)
+                merged = {line[2:] for line in
+                          self.oec.git.branch('--merged', 'master')
+                              .splitlines()}
+                with self.__ref_lock:
+                    for name, head in self.__branches().items():
+                        if name in keep:
+                            continue
+                        if name in merged or \
+                                pushed.get(name) == head.commit.hexsha:
+                            pruned.append(name)
+                    self.__delete_heads(pruned)
+                logging.info("Pruned %d branch(es)" % len(pruned))
+                # only the modification time of the stamp matters
+                with open(path.join(self.oec.git_dir, self.PRUNE_STAMP),
+                          'w') as stamp:
+                    stamp.write('%f\n' % time.time())
+            except git.exc.GitCommandError as e:
+                logging.error("Unable to prune branches")
+                logging.error(e.stderr)
+        logging.info("prune_branches: Execution terminated")
+        return len(pruned)
+
+    def __prune_due(self, interval: float) -> bool:
+        """
+        :param interval: Seconds between two prunes.
+        :return: Whether the branches were last pruned longer ago.
+        """
+        try:
+            pruned_at = os.stat(path.join(self.oec.git_dir,
+                                          self.PRUNE_STAMP)).st_mtime
+        except OSError:
+            return True     # never pruned
+        return not 0 <= time.time() - pruned_at < interval
+
     def commit(self, commit_message: str) -> str:
         """
         Commit changes to the current branch.
@@ -160,7 +371,9 @@ class RepoManager:
         created_branch = ""
         if self.__destroyed is not True:
             try:
-                self.oec.refs.master.checkout(b=name, t=True)
+                self.__change_branches(
+                    lambda: self.oec.refs.master.checkout(b=name, t=True),
+                    added=[name])
                 logging.info("branch " + name +
                              " has been created on repo self.oec")
                 created_branch = name
@@ -182,13 +395,12 @@ class RepoManager:
         push_success = False
         if self.__destroyed is not True:
             try:
-                for indx in range(0, len(self.oec.branches)):
-                    if self.oec.branches[indx].name == branch_name:
-                        self.__remote.push(self.oec.branches[indx])
-                        logging.info("Push successful")
-                        push_success = True
-                        break
-                if not push_success:
+                head = self.find_branch(branch_name)
+                if head is not None:
+                    self.__remote.push(head)
+                    logging.info("Push successful")
+                    push_success = True
+                else:
                     logging.error("No such branch '" + branch_name +
                                   "' exists")
             except git.exc.GitCommandError as e:
@@ -197,24 +409,140 @@ class RepoManager:
         logging.info("push: Execution terminated")
         return push_success
 
-    def pull(self) -> None:
+    def push_branches(self, branch_names: List[str]) -> List[str]:
+        """
+        Pushes several branches to the remote at once.
+        :param branch_names: Branch names.
+        :return: Names of the branches that were successfully pushed.
+        """
+        logging.info("push_branches: Execution started")
+        pushed = []
+        if self.__destroyed is not True and branch_names:
+            refspecs = ['refs/heads/%s:refs/heads/%s' % (name, name)
+                        for name in branch_names]
+            try:
+                for info in self.__remote.push(refspecs):
+                    name = info.remote_ref_string[len('refs/heads/'):]
+                    if info.flags & git.PushInfo.ERROR:
+                        logging.error("Unable to push branch %s: %s"
+                                      % (name, info.summary.strip()))
+                    else:
+                        pushed.append(name)
+                logging.info("Pushed %d of %d branch(es)"
+                             % (len(pushed), len(branch_names)))
+            except git.exc.GitCommandError as e:
+                logging.error("Unable to push branches")
+                logging.error(e.stderr)
+        logging.info("push_branches: Execution terminated")
+        return pushed
+
+    def pull(self) -> Optional[Tuple[str, str]]:
         """
         Pull the master branch.
-        :return Whether the pull was successful
+        :return: A tuple (old HEAD, new HEAD) of commit hashes if the pull was
+        successful, None otherwise. Both hashes are the same if nothing came in
         """
         logging.info("pull: Execution started")
-        pull_success = False
+        pull_result = None
         if self.__destroyed is not True:
             try:
                 # switch to master branch and pull
                 self.checkout()
-                self.__remote.pull()
-                pull_success = True
+                old_head = self.oec.head.commit.hexsha
+                if self.depth:
+                    # a shallow history cannot be merged, master never has
+                    # local commits so it can simply follow the remote
+                    self.__remote.fetch('+refs/heads/master:'
+                                        'refs/remotes/origin/master',
+                                        depth=self.depth)
+                    self.oec.head.reset('refs/remotes/origin/master',
+                                        index=True, working_tree=True)
+                else:
+                    self.__remote.pull()
+                pull_result = (old_head, self.oec.head.commit.hexsha)
             except git.exc.GitCommandError as e:
                 logging.error("Unable to push current branch")
                 logging.error(e.stderr)
         logging.info("pull: Execution terminated")
-        return pull_success
+        return pull_result
+
+    def head(self) -> str:
+        """
+        :return: Commit hash of the current HEAD. Empty string if error
+        occurred
+        """
+        head_hash = ""
+        if self.__destroyed is not True:
+            try:
+                head_hash = self.oec.head.commit.hexsha
+            except ValueError as e:
+                logging.error(e)
+        return head_hash
+
+    def diff(self, old_commit: str, new_commit: str,
+             directories: List[str]=None) -> Optional[List['FileChange']]:
+        """
+        Lists the files changed between two commits.
+        :param old_commit: Commit hash to compare from.
+        :param new_commit: Commit hash to compare to.
+        :param directories: Only report changes under these directories
+        (relative to the repository root). All changes if None.
+        :return: List of file changes. None if error occurred
+        """
+        changes = None
+        if self.__destroyed is not True:
+            try:
+                diffs = self.oec.commit(old_commit).diff(new_commit,
+                                                         paths=directories)
+                changes = [FileChange(d.change_type,
+                                      None if d.new_file else d.a_path,
+                                      None if d.deleted_file else d.b_path,
+                                      d.b_blob.hexsha if d.b_blob else None)
+                           for d in diffs]
+            except (git.exc.GitCommandError, ValueError) as e:
+                logging.error("Unable to diff %s..%s: %s"
+                              % (old_commit, new_commit, e))
+        return changes
+
+    def list_blobs(self, directory: str) -> Dict[str, str]:
+        """
+        Lists the files directly under a directory at the current HEAD,
+        along with their git blob SHA.
+        :param directory: Directory relative to the repository root.
+        :return: Dict of file path (relative to the repository root, using
+        forward slashes) -> blob SHA. Empty if the directory does not exist.
+        """
+        blobs = dict()
+        if self.__destroyed is not True:
+            try:
+                tree = self.oec.head.commit.tree / directory
+                for blob in tree.blobs:
+                    blobs[blob.path] = blob.hexsha
+            except (KeyError, ValueError) as e:
+                logging.warning("Unable to list '%s': %s" % (directory, e))
+        return blobs
+
+    def read_file(self, commit: str, file_path: str) -> Optional[bytes]:
+        """
+        Reads a file at a specific commit, without touching the working tree.
+        Safe to call from several threads.
+        :param commit: Commit hash.
+        :param file_path: Path relative to the repository root, using
+        forward slashes.
+        :return: Content of the file. None if the commit or the file is not
+        in the local repository.
+        """
+        if self.__destroyed is True:
+            return None
+        with self.__object_lock:
+            try:
+                blob = self.oec.commit(commit).tree / file_path
+                return blob.data_stream.read()
+            except (KeyError, ValueError, git.exc.BadName,
+                    git.exc.BadObject) as e:
+                logging.debug("Unable to read %s at %s: %s"
+                              % (file_path, commit, e))
+                return None
 
     def destroy(self) -> None:
         """
@@ -223,6 +551,9 @@ class RepoManager:
         logging.info("destroy: Execution started")
         # free the memory for gitPython and reset variables.
         if self.oec is not None:
+            while not self.__worktree_pool.empty():
+                self.__worktree_pool.get_nowait().close()
+            self.__worktree_count = 0
             rmtree(self.root, onerror=self.__del_helper)\
                 if not self.root == "" else None
             self.oec.__del__()
@@ -256,19 +587,16 @@ class RepoManager:
         if self.__destroyed is not True:
             try:
                 self.checkout()
-                if br_name is not "master":
-                    for indx in range(0, len(self.oec.branches)):
-                        if br_name == "":
-                            self.oec.delete_head(self.oec.branches[indx]) if \
-                                self.oec.branches[indx].name != "master" \
-                                else None
-
-                        elif self.oec.branches[indx].name == br_name:
-                            self.oec.delete_head(self.oec.branches[indx])
-                            self.__remote.push(":" + br_name) if remote else \
-                                None
-                            del_success = True
-                            break
+                if br_name == "":
+                    self.__delete_heads([name for name in self.__branches()
+                                         if name != "master"])
+                elif br_name != "master":
+                    head = self.find_branch(br_name)
+                    if head is not None:
+                        self.__delete_heads([br_name])
+                        self.__remote.push(":" + br_name) if remote else \
+                            None
+                        del_success = True
             except git.exc.GitCommandError as e:
                 logging.error(e.stderr)
         logging.info("delete_branch: Execution terminated")
@@ -322,6 +650,157 @@ class RepoManager:
         logging.info("submit: Execution terminated")
         return commit_hash
 
+    def __add_worktree(self, index: int) -> git.Repo:
+        """
+        Creates a linked worktree, or reuses the one left by a previous run.
+        Nothing is checked out in it, only its index and HEAD are used.
+        """
+        tree_path = path.join(self.oec.git_dir, self.WORKTREE_DIR, str(index))
+        if path.isdir(tree_path):
+            try:
+                return git.Repo(tree_path)
+            except (git.exc.InvalidGitRepositoryError,
+                    git.exc.NoSuchPathError):
+                rmtree(tree_path, onerror=self.__del_helper)
+        self.oec.git.worktree('prune')
+        self.oec.git.worktree('add', '--detach', '--no-checkout',
+                              tree_path, 'master')
+        logging.debug("Created worktree " + tree_path)
+        return git.Repo(tree_path)
+
+    @contextmanager
+    def worktree(self) -> Iterator[git.Repo]:
+        """
+        Leases a linked worktree of the repository, blocks until one is idle.
+        Every worktree has its own HEAD, index and git process environment,
+        so work done in different worktrees never interferes. The worktree
+        is reset to master when it is returned to the pool.
+        Usage: with repo.worktree() as tree: ...
+        :return: Context manager of the worktree.
+        """
+        try:
+            tree = self.__worktree_pool.get_nowait()
+        except queue.Empty:
+            with self.__worktree_lock:
+                index = self.__worktree_count
+                if index < self.worktrees:
+                    self.__worktree_count += 1
+            if index < self.worktrees:
+                try:
+                    tree = self.__add_worktree(index)
+                except git.exc.GitCommandError:
+                    with self.__worktree_lock:
+                        self.__worktree_count -= 1
+                    raise
+            else:
+                tree = self.__worktree_pool.get()
+        try:
+            yield tree
+        finally:
+            try:
+                tree.git.reset('--quiet', 'master')
+            except git.exc.GitCommandError as e:
+                logging.warning("Unable to reset worktree %s: %s"
+                                % (tree.working_tree_dir, e.stderr))
+            self.__worktree_pool.put(tree)
+
+    def commit_file(self, branch_name: str, file_path: str, content: str,
+                    msg: str, base: str='master') -> str:
+        """
+        Creates a branch off another one, with a single commit changing one
+        file. The blob, tree and commit are written straight into the object
+        database through a leased worktree, neither the main working tree nor
+        its index is touched, so several branches can be built at the same
+        time.
+        :param branch_name: Name of the new branch, must not exist yet.
+        :param file_path: Path of the file relative to the repository root,
+        using forward slashes.
+        :param content: New content of the file.
+        :param msg: Commit message.
+        :param base: Branch to build on.
+        :return: Commit hash. Empty string if error occurred
+        """
+        commit_hash = ""
+        if self.__destroyed is True:
+            return commit_hash
+        try:
+            with self.worktree() as tree:
+                commit_hash = self.__commit_file(tree, branch_name, file_path,
+                                                 content, msg, base)
+            logging.info("Committed %s to branch %s"
+                         % (file_path, branch_name))
+        except git.exc.GitCommandError as e:
+            logging.error("Unable to commit to branch " + branch_name)
+            logging.error(e.stderr)
+            commit_hash = ""
+        return commit_hash
+
+    def __commit_file(self, tree: git.Repo, branch_name: str,
+                      file_path: str, content: str, msg: str,
+                      base: str) -> str:
+        """
+        Does the work of commit_file() in a leased worktree.
+        :return: Commit hash.
+        """
+        fd, tmp_file = tempfile.mkstemp(dir=tree.git_dir, prefix='oec-sync-')
+        try:
+            # write the file content as-is, don't convert line endings
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content.encode('utf-8'))
+            blob_sha = tree.git.hash_object('-w', '--no-filters', tmp_file)
+        finally:
+            os.remove(tmp_file)
+
+        # base tree with the one file replaced, in the worktree's own index
+        base_commit = tree.git.rev_parse('refs/heads/' + base)
+        tree.git.read_tree(base_commit)
+        tree.git.update_index('--add', '--cacheinfo', '100644',
+                              blob_sha, file_path)
+        tree_sha = tree.git.write_tree()
+
+        # same identity as the commits made through the index, falls
+        # back to a default one if git is not configured
+        config = tree.config_reader()
+        author = git.Actor.author(config)
+        committer = git.Actor.committer(config)
+        with tree.git.custom_environment(
+                GIT_AUTHOR_NAME=author.name,
+                GIT_AUTHOR_EMAIL=author.email,
+                GIT_COMMITTER_NAME=committer.name,
+                GIT_COMMITTER_EMAIL=committer.email):
+            commit_hash = tree.git.commit_tree(tree_sha, '-p', base_commit,
+                                               '-m', msg)
+        # the zero hash makes sure an existing branch is never moved
+        self.__change_branches(
+            lambda: tree.git.update_ref('refs/heads/' + branch_name,
+                                        commit_hash, '0' * 40),
+            added=[branch_name])
+        return commit_hash
+
+    def build_branches(self, changes: List[Tuple[str, str, str, str]]) \
+            -> Dict[str, str]:
+        """
+        Creates one branch off master for every change, each with a single
+        commit changing one file. The branches are built concurrently, one
+        per worktree. Nothing is pushed, and the working tree is never
+        touched.
+        :param changes: List of tuples (branch name, file path relative to
+        the repository root, new file content, commit message)
+        :return: Dict of branch name -> commit hash, of the branches created
+        """
+        logging.info("build_branches: Execution started")
+        commits = dict()
+        if changes:
+            with ThreadPoolExecutor(
+                    max_workers=min(self.worktrees, len(changes))) as pool:
+                hashes = pool.map(lambda c: self.commit_file(*c), changes)
+                for change, commit_hash in zip(changes, hashes):
+                    if commit_hash:
+                        commits[change[0]] = commit_hash
+        logging.info("build_branches: Execution terminated")
+        return commits
+
+
 if __name__ == '__main__':
     # implement standalone app tester
     from os import getcwd
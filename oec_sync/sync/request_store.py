@@ -0,0 +1,233 @@
+from collections.abc import MutableMapping
+from typing import Any, Callable, Iterator, Optional, Tuple
+import dbm
+import logging
+import os
+import pickle
+import shelve
+import sqlite3
+import threading
+
+
+class RequestStore(MutableMapping):
+    """
+    SQLite store of cached pull requests.
+
+    Every pull request is one row, keyed by its number (as a string, like
+    the shelve this replaces). The state and checksum of a request are
+    kept in indexed columns, so they can be queried without unpickling
+    anything. Changes are written in one transaction on commit().
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            num INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            checksum TEXT,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS requests_state ON requests (state);
+        CREATE INDEX IF NOT EXISTS requests_checksum ON requests (checksum);
+    """
+
+    # key prefix of metadata in the old shelve files
+    SHELVE_META_PREFIX = 'META:'
+
+    def __init__(self,
+                 db_file: str,
+                 describe: Callable[[Any], Tuple[str, Optional[str]]]):
+        """
+        Opens the store, importing the old shelve file at the same path
+        if there is one.
+        :param db_file: Path to the database file.
+        :param describe: Function returning (state, checksum) of a value,
+                         raises TypeError if the value cannot be stored.
+        """
+        self.db_file = db_file
+        self.__describe = describe
+        self.__lock = threading.RLock()
+
+        legacy = self.__read_shelve(db_file)
+        self.__conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.__conn.executescript(self.SCHEMA)
+        if legacy is not None:
+            self.__import_shelve(legacy)
+
+    def close(self) -> None:
+        """
+        Commits pending changes and closes the database.
+        """
+        with self.__lock:
+            if self.__conn is not None:
+                self.__conn.commit()
+                self.__conn.close()
+                self.__conn = None
+
+    def commit(self) -> None:
+        """
+        Writes all pending changes to disk.
+        """
+        with self.__lock:
+            self.__conn.commit()
+
+    def __execute(self, sql: str, params: tuple=()) -> sqlite3.Cursor:
+        with self.__lock:
+            return self.__conn.execute(sql, params)
+
+    def __load(self, num: int, data: bytes) -> Any:
+        """
+        Unpickles a stored value. Corrupted rows are dropped.
+        """
+        try:
+            value = pickle.loads(data)
+            self.__describe(value)
+            return value
+        except Exception as e:
+            logging.debug("Dropping corrupted request #%d: %s" % (num, e))
+            self.__execute("DELETE FROM requests WHERE num = ?", (num,))
+            return None
+
+    @staticmethod
+    def __num(key: str) -> int:
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+
+    def __getitem__(self, key: str) -> Any:
+        num = self.__num(key)
+        row = self.__execute("SELECT data FROM requests WHERE num = ?",
+                             (num,)).fetchone()
+        value = None if row is None else self.__load(num, row[0])
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        state, checksum = self.__describe(value)
+        self.__execute("INSERT OR REPLACE INTO requests "
+                       "(num, state, checksum, data) VALUES (?, ?, ?, ?)",
+                       (self.__num(key), state, checksum,
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    def __delitem__(self, key: str) -> None:
+        cursor = self.__execute("DELETE FROM requests WHERE num = ?",
+                                (self.__num(key),))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self.__execute("SELECT num FROM requests ORDER BY num")
+        return iter([str(num) for num, in rows.fetchall()])
+
+    def __len__(self) -> int:
+        return self.__execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+
+    def __contains__(self, key: Any) -> bool:
+        try:
+            num = self.__num(key)
+        except KeyError:
+            return False
+        return self.__execute("SELECT 1 FROM requests WHERE num = ?",
+                              (num,)).fetchone() is not None
+
+    def items(self) -> list:
+        """
+        :return: List of (key, value) of all readable requests.
+        """
+        rows = self.__execute("SELECT num, data FROM requests "
+                              "ORDER BY num").fetchall()
+        items = [(str(num), self.__load(num, data)) for num, data in rows]
+        return [item for item in items if item[1] is not None]
+
+    def values(self) -> list:
+        """
+        :return: List of all readable requests.
+        """
+        return [value for key, value in self.items()]
+
+    def clear(self) -> None:
+        """
+        Removes all requests and metadata.
+        """
+        with self.__lock:
+            self.__conn.execute("DELETE FROM requests")
+            self.__conn.execute("DELETE FROM meta")
+
+    def find(self, checksum: str) -> Any:
+        """
+        Finds a request by checksum.
+        :param checksum: Checksum of the request.
+        :return: The most recent request with the checksum, if any.
+        """
+        rows = self.__execute("SELECT num, data FROM requests "
+                              "WHERE checksum = ? ORDER BY num DESC",
+                              (checksum,)).fetchall()
+        for num, data in rows:
+            value = self.__load(num, data)
+            if value is not None:
+                return value
+        return None
+
+    def count_states(self) -> dict:
+        """
+        :return: Number of requests in each state.
+        """
+        return dict(self.__execute("SELECT state, COUNT(*) FROM requests "
+                                   "GROUP BY state").fetchall())
+
+    def get_meta(self, key: str) -> Any:
+        row = self.__execute("SELECT value FROM meta WHERE key = ?",
+                             (key,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def set_meta(self, key: str, value: Any) -> None:
+        self.__execute("INSERT OR REPLACE INTO meta (key, value) "
+                       "VALUES (?, ?)",
+                       (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    @staticmethod
+    def __read_shelve(db_file: str) -> Optional[dict]:
+        """
+        Reads a shelve file left by older versions, and moves it out of
+        the way so the SQLite database can take its place.
+        :return: Content of the shelve, None if there is no shelve file.
+        """
+        if dbm.whichdb(db_file) in (None, '', 'dbm.sqlite3'):
+            # missing, or not a shelve file (e.g. already migrated)
+            return None
+        logging.info("Migrating request cache from %s..." % db_file)
+        try:
+            with shelve.open(db_file, 'r') as cache:
+                content = dict()
+                for key in list(cache.keys()):
+                    try:
+                        content[key] = cache[key]
+                    except Exception as e:
+                        logging.debug("Skipping %s: %s" % (key, e))
+        except Exception as e:
+            logging.warning("Failed reading request cache: %s" % e)
+            content = dict()
+
+        # the different dbm implementations use different file names
+        for suffix in ('', '.db', '.dat', '.dir', '.bak', '.pag'):
+            if os.path.exists(db_file + suffix):
+                os.replace(db_file + suffix, db_file + '.shelve' + suffix)
+        return content
+
+    def __import_shelve(self, content: dict) -> None:
+        imported = 0
+        for key, value in content.items():
+            if key.startswith(self.SHELVE_META_PREFIX):
+                self.set_meta(key[len(self.SHELVE_META_PREFIX):], value)
+                continue
+            try:
+                self[key] = value
+                imported += 1
+            except (KeyError, TypeError, AttributeError):
+                logging.debug("Skipping unknown item: %s" % key)
+        self.commit()
+        logging.info("Imported %d cached request(s)" % imported)
@@ -1,11 +1,16 @@
 import os
 import glob
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from update_request import *
 from repo_manager import *
 from catalogue import *
 import oec
-from typing import Callable, Optional
+from typing import Callable, Iterable, List, Optional, Set, Tuple
 from comparer import data_compare
+from system_cache import SystemCache
+from blob_cache import BlobCache
+from astro_unit import Quantity
 from syncutil import SrcPath, Helper, ProgressCallback
 
 
@@ -16,12 +21,22 @@ class Synchronizer:
     """
     DATAPATH_OEC = 'oec'
     DATAPATH_REQUEST_CACHE = 'requests.db'
+    DATAPATH_BLOB_CACHE = 'blobs'
+    DATAPATH_SYSTEM_CACHE = 'systems.cache'
+    DATAPATH_CATALOGUES = 'catalogues'
+    DATAPATH_UNIT_TABLE = 'units.json'
     DATAPATH_ROOT = '.oec-sync'
 
     # systems under 'systems' and 'systems_kepler' are overlapping.
     # for example, Kepler-386 == KOI-2442
     SYSTEM_PATHS = ['systems']  # , 'systems_kepler']
 
+    # default number of commits of OEC history kept locally
+    OEC_CLONE_DEPTH = 1
+
+    # default hours between syncs that compare every system
+    FULL_SYNC_INTERVAL = 24
+
     def __init__(self, config_file: str, data_root: str=None):
         """
         :param config_file: Path to the synchronizer configuration file.
@@ -49,69 +64,99 @@ class Synchronizer:
                                              config['gh_api_token']))
         self.oec_repo = RepoManager(
                 self._datapath(Synchronizer.DATAPATH_OEC),
-                oec_git_path)
+                oec_git_path,
+                Synchronizer.SYSTEM_PATHS,
+                config.get('oec_clone_depth', Synchronizer.OEC_CLONE_DEPTH),
+                config.get('oec_worktrees') or RepoManager.WORKTREES)
+
+        # unit lookups from previous runs, so pint is rarely needed
+        Quantity.load_unit_table(
+                self._datapath(Synchronizer.DATAPATH_UNIT_TABLE))
 
         # create the adapter that manipulates oec files
         self.oec_adapter = oec.Adapter()
+        self.parse_workers = config.get('parse_workers') or 1
+        self.full_sync_interval = 3600 * config.get(
+                'full_sync_interval', Synchronizer.FULL_SYNC_INTERVAL)
 
         # load oec into memory
-        self.oec_system = dict()
+        self.oec_system = dict()    # sanitized system name -> system
+        self.oec_files = dict()     # system file (relative path) -> system
+        self._oec_shadowed = dict()  # name -> systems losing naming conflicts
+        self._oec_head = ''         # commit that the loaded systems reflect
+        self.system_cache = SystemCache(
+                self._datapath(Synchronizer.DATAPATH_SYSTEM_CACHE))
         self._reload_oec()
 
         # initialize update request database
         self.db = UpdateRequestDB(
                 self._datapath(Synchronizer.DATAPATH_REQUEST_CACHE),
                 config['gh_api_token'],
-                config['gh_repo'])
+                config['gh_repo'],
+                config.get('fetch_workers') or UpdateRequestDB.FETCH_WORKERS,
+                BlobCache(self._datapath(Synchronizer.DATAPATH_BLOB_CACHE)),
+                self.oec_repo.read_file)
 
         # initialize list of monitored catalogues
         self.cats = []
         self._reload_cat_config()
 
     def sync(self, callback: Callable[[UpdateRequest], None],
-             progress: ProgressCallback=None) -> None:
+             progress: ProgressCallback=None,
+             changed_only: bool=False) -> None:
         """
         Get changes from monitored catalogue.
         :param callback: handler of new update request
         :param progress: handler of progress update event
+        :param changed_only: compare only the systems that changed, in the
+        catalogue or in OEC, since the last sync. Every system is still
+        compared once per full_sync_interval.
         """
         update_progress = progress or (lambda a, b, c=None: True)
 
         # pull oec repository before sync
         self.oec_repo.checkout()
-        self.oec_repo.pull()
-        self._reload_oec()
+        old_head, new_head = self.oec_repo.pull() or (None, None)
+        self._reload_oec(old_head, new_head)
+        # drop the branches of pull requests that no longer need them,
+        # every once in a while since it asks the remote for its branches
+        self.oec_repo.prune_branches(self.full_sync_interval)
 
         # synchronize existing update request with Github pull request
         self.db.fetch_all(progress=update_progress)
 
         # fetch latest catalogues
-        update_progress(0, len(self.cats), "Fetching data...")
-        sys_total = 0
-        for cat_i, cat in enumerate(self.cats):
-            logging.info('Fetching data from [%s]...' % cat.config.name)
-            cat.fetch()
-
-            sys_count = len(cat.systems)
-            logging.info("Found %d systems in the catalogue" % sys_count)
-            sys_total += sys_count
-
-            update_progress(cat_i+1, len(self.cats))
+        cats = self._fetch_catalogues(update_progress)
+        sys_total = sum(len(cat.systems) for cat in cats)
 
         sys_processed = 0
         update_count = 0
         unknown_count = 0
         skip_count = 0
+        unchanged_count = 0
 
-        for cat_idx, cat in enumerate(self.cats):
+        full_syncs = []
+        for cat_idx, cat in enumerate(cats):
             logging.info('Syncing with [%s]...' % cat.config.name)
 
-            for cat_sysname, system in cat.systems.items():
-                oec_sys = self.oec_system.get(Body.sanitize_name(cat_sysname))
+            # names of changed catalogue systems and changed OEC systems,
+            # None to compare everything
+            changed = self._changed_systems(cat) if changed_only else None
+            full_syncs.append(changed is None)
+
+            for cat_sysname in cat.systems:
+                sanitized_name = Body.sanitize_name(cat_sysname)
+                oec_sys = self.oec_system.get(sanitized_name)
+                if changed is not None and \
+                        cat_sysname not in changed[0] and \
+                        sanitized_name not in changed[1]:
+                    # neither side changed since the last sync
+                    unchanged_count += 1
                 # find the matching system in OEC
-                if oec_sys is not None:
+                elif oec_sys is not None:
                     logging.debug("Analysing " + oec_sys.name)
-                    sysupd = data_compare(oec_sys, system)
+                    # the catalogue system is only built here
+                    sysupd = self._compare(oec_sys, cat, cat_sysname)
                     if sysupd is not None:
                         # found a change
                         req = UpdateRequest(sysupd, reference=cat.config.name)
@@ -138,14 +183,108 @@ class Synchronizer:
 
             logging.info("[%s] Done" % cat.config.name)
 
+        # remember what has been synced
+        for cat, full in zip(cats, full_syncs):
+            cat.commit(self._oec_head, full)
+        self._save_unit_table()
+
         logging.info("Sync completed:\n"
-                     "Processed %d systems(s)\n"
+                     "Processed %d systems(s) (%d unchanged)\n"
                      "created %d update request(s) (+%d skipped)\n"
                      "found %d unknown system(s)\n" %
-                     (sys_processed,
+                     (sys_processed, unchanged_count,
                       update_count, skip_count,
                       unknown_count))
 
+    @staticmethod
+    def _compare(oec_sys: System, cat: MonitoredCatalogue,
+                 cat_sysname: str) -> Optional[PlanetarySysUpdate]:
+        """
+        Compares a system in OEC with the same system in a catalogue.
+        :param oec_sys: The system in OEC.
+        :param cat: The catalogue.
+        :param cat_sysname: Name of the system in the catalogue.
+        :return: Changes to be made to the OEC system, None if there is
+        nothing to change or the catalogue has invalid data for the system.
+        """
+        try:
+            system = cat.systems[cat_sysname]
+        except ValueError as e:
+            logging.error('[%s] Invalid data in system "%s": %s' %
+                          (cat.config.name, cat_sysname, e))
+            return None
+        return data_compare(oec_sys, system)
+
+    def _fetch_catalogues(self, progress: ProgressCallback) \
+            -> List[MonitoredCatalogue]:
+        """
+        Fetches all catalogues concurrently. A catalogue that fails to fetch
+        is left out of this sync, without affecting the others.
+        :param progress: handler of progress update event
+        :return: The catalogues fetched successfully, in configuration order.
+        """
+        progress(0, len(self.cats), "Fetching data...")
+        if not self.cats:
+            return []
+
+        def fetch(cat: MonitoredCatalogue) -> None:
+            logging.info('Fetching data from [%s]...' % cat.config.name)
+            cat.fetch()
+            logging.info("[%s] Found %d systems in the catalogue" %
+                         (cat.config.name, len(cat.systems)))
+
+        fetched = set()
+        with ThreadPoolExecutor(max_workers=len(self.cats)) as executor:
+            futures = {executor.submit(fetch, cat): cat for cat in self.cats}
+            # report progress from this thread as the fetches complete
+            for done, future in enumerate(as_completed(futures)):
+                cat = futures[future]
+                try:
+                    future.result()
+                    fetched.add(cat)
+                except Exception as e:
+                    logging.error('Failed fetching data from [%s]: %s' %
+                                  (cat.config.name, e))
+                progress(done + 1, len(self.cats))
+
+        return [cat for cat in self.cats if cat in fetched]
+
+    def _changed_systems(self, cat: MonitoredCatalogue) \
+            -> Optional[Tuple[Set[str], Set[str]]]:
+        """
+        Finds the systems that need to be compared in a changed-only sync.
+        :param cat: A fetched catalogue.
+        :return: Tuple (names of catalogue systems whose rows changed,
+        sanitized names of OEC systems changed since the catalogue was last
+        synced). None if every system should be compared.
+        """
+        if cat.changed_systems is None or not cat.synced_oec_head:
+            logging.info("[%s] No previous sync, comparing every system" %
+                         cat.config.name)
+            return None
+        if time.time() - cat.last_full_sync >= self.full_sync_interval:
+            logging.info("[%s] Full reconciliation is due" % cat.config.name)
+            return None
+
+        oec_changed = set()
+        if cat.synced_oec_head != self._oec_head:
+            changes = self.oec_repo.diff(cat.synced_oec_head, self._oec_head,
+                                         Synchronizer.SYSTEM_PATHS)
+            if changes is None:
+                return None
+            # deleted files have nothing left to compare against, a name
+            # they free up is picked up by the next full reconciliation
+            for change in changes:
+                system = self.oec_files.get(change.new_path)
+                if system is not None:
+                    oec_changed.update(system.all_names)
+
+        logging.info("[%s] Comparing %d changed catalogue system(s) and "
+                     "%d changed OEC system name(s)" %
+                     (cat.config.name, len(cat.changed_systems),
+                      len(oec_changed)))
+        return cat.changed_systems, oec_changed
+
     def get_system_file(self, system_name: str) -> str:
         """
         Locates a system file from the local oec repository.
@@ -168,13 +307,49 @@ class Synchronizer:
         :param force: ignore duplicates
         :return: pull request id
         """
+        edit = self._edit_system_file(req, editor)
+        if edit is None:
+            return
+        filename, file_content = edit
+
+        logging.info("Pushing update to remote branch '%s'" % req.branch)
+        commit_hash = self.oec_repo.commit_file(req.branch,
+                                                self._repo_path(filename),
+                                                file_content,
+                                                req.get_summary())
+        logging.debug("Commit hash: " + commit_hash)
+        if commit_hash:
+            self.oec_repo.push(req.branch)
+
+        # submit pull request
+        logging.info("Creating pull request...")
+        self.db.submit(req, force)
+        return req.pullreq_num
+
+    def _edit_system_file(self,
+                          req: UpdateRequest,
+                          editor: Callable[[str], str]=None) \
+            -> Optional[Tuple[str, str]]:
+        """
+        Applies an update request to its system file, in memory.
+        :param req: the update request
+        :param editor: function that edits and returns the final content
+        :return: tuple (path to the system file, new content), None if the
+        editor emptied the file
+        """
         filename = self.get_system_file(req.updates.name)
         if not filename:
             raise FileNotFoundError("Could not locate the system file")
 
-        file_content = ''
-        with open(filename, 'r') as f:
-            file_content = f.read()
+        # read the file as loaded, a sync may be pulling into the working
+        # tree while submissions run in other threads
+        content = self.oec_repo.read_file(self._oec_head,
+                                          self._repo_path(filename))
+        if content is not None:
+            file_content = content.decode('utf-8')
+        else:
+            with open(filename, 'r') as f:
+                file_content = f.read()
 
         # apply the update to the in-memory file content
         logging.info("Applying update to system [%s]" % req.updates.name)
@@ -186,28 +361,48 @@ class Synchronizer:
             file_content = editor(file_content)
             if not file_content:
                 logging.info("File is empty. Abort submission.")
-                return
+                return None
 
         # make sure there is newline at the end of file
         if file_content[-1] != '\n':
             file_content += '\n'
 
-        def write_file():
-            # overwrite the entire file, don't convert line endings
-            with open(filename, 'w', newline='') as f:
-                f.write(file_content)
-            return True
+        return filename, file_content
 
-        logging.info("Pushing update to remote branch '%s'" % req.branch)
-        commit_hash = self.oec_repo.submit(req.get_summary(),
-                                           req.branch,
-                                           write_file)
-        logging.debug("Commit hash: " + commit_hash)
+    def submit_many(self, reqs: List[UpdateRequest], force: bool=False) \
+            -> List[UpdateRequest]:
+        """
+        Submits several update requests to OEC as Github pull requests.
+        All branches are built first, then pushed at once.
+        :param reqs: the update requests
+        :param force: ignore duplicates
+        :return: the update requests with a pull request created
+        """
+        if not force:
+            reqs = self.db.remove_duplicates(reqs)
 
-        # submit pull request
-        logging.info("Creating pull request...")
-        self.db.submit(req, force)
-        return req.pullreq_num
+        # compute every edit before touching the repository
+        changes = []
+        branches = dict()   # branch name -> update request
+        for req in reqs:
+            try:
+                filename, file_content = self._edit_system_file(req)
+                summary = req.get_summary()
+            except (FileNotFoundError, AttributeError, FormatError) as e:
+                logging.error("Unable to update [%s]: %s"
+                              % (req.updates.name, e))
+                continue
+            changes.append((req.branch, self._repo_path(filename),
+                            file_content, summary))
+            branches[req.branch] = req
+
+        logging.info("Pushing %d update(s) to remote branches" % len(changes))
+        commits = self.oec_repo.build_branches(changes)
+        pushed = self.oec_repo.push_branches(list(commits))
+
+        # submit pull requests
+        logging.info("Creating %d pull request(s)..." % len(pushed))
+        return self.db.submit_many([branches[name] for name in pushed])
 
     def reject(self, req: UpdateRequest, force: bool=False):
         """
@@ -221,31 +416,203 @@ class Synchronizer:
             self.db.reject(req)
         return pullreq_num
 
+    def _repo_path(self, file: str) -> str:
+        """
+        :param file: Path to a file in the local oec repository.
+        :return: Path relative to the repository root, using forward slashes.
+        """
+        return os.path.relpath(file, self.oec_repo.root).replace(os.sep, '/')
+
     def _datapath(self, name: str = None):
         return os.path.join(self.data_root, name)
 
-    def _reload_oec(self) -> None:
+    def _reload_oec(self, old_head: str=None, new_head: str=None) -> None:
         """
         Reload OEC from local repository.
+        If the commits before and after the last pull are given, only the
+        system files changed in between are reloaded. Otherwise every system
+        file is loaded, parsing only those that changed since they were last
+        cached.
+        :param old_head: HEAD commit before the pull.
+        :param new_head: HEAD commit after the pull.
         """
+        if old_head and new_head and old_head == self._oec_head:
+            if old_head == new_head:
+                logging.info("OEC systems are up-to-date")
+                return
+            changes = self.oec_repo.diff(old_head, new_head,
+                                         Synchronizer.SYSTEM_PATHS)
+            if changes is not None:
+                self._patch_oec(changes)
+                self._oec_head = new_head
+                self._save_system_cache()
+                return
+
         logging.info("Parsing OEC systems...")
         oec_path = self.oec_repo.root
         self.oec_system.clear()
+        self.oec_files.clear()
+        self._oec_shadowed.clear()
+        self._oec_head = self.oec_repo.head()
+
+        # list system files in a stable order, so naming conflicts are
+        # always resolved the same way
+        entries = []
         for system_path in Synchronizer.SYSTEM_PATHS:
+            blobs = self.oec_repo.list_blobs(system_path)
             pattern = os.path.join(oec_path, system_path, '*.xml')
-            for system_file in glob.glob(pattern):
-                system = self.oec_adapter.read_system(system_file)
-
-                # map all alternate names to this system object
-                for sys_name in system.all_names:
-                    if sys_name in self.oec_system:
-                        # this means two different systems have the same name
-                        logging.debug("Naming conflict between <%s> and <%s>"
-                                      % (self.oec_system[sys_name].name,
-                                         system.name))
-                        continue
-                    self.oec_system[sys_name] = system
-                logging.debug("Loaded " + system_file)
+            for system_file in sorted(glob.glob(pattern)):
+                key = os.path.relpath(system_file, oec_path)\
+                    .replace(os.sep, '/')
+                entries.append((key, blobs.get(key)))
+
+        systems = self._load_systems(entries)
+        for (key, blob_sha), system in zip(entries, systems):
+            self._add_system(key, system)
+            logging.debug("Loaded " + system.file)
+
+        # forget files that no longer exist, and persist the cache
+        self.system_cache.retain(self.oec_files)
+        self._save_system_cache()
+
+    def _patch_oec(self, changes: List[FileChange]) -> None:
+        """
+        Applies changes of system files to the loaded OEC systems.
+        :param changes: Files changed since the systems were loaded.
+        """
+        def is_system_file(key: Optional[str]) -> bool:
+            return bool(key) and key.endswith('.xml') and \
+                os.path.dirname(key) in Synchronizer.SYSTEM_PATHS
+
+        # remove the old version of every changed file first, so the
+        # names they held are free for the new versions
+        for change in changes:
+            if is_system_file(change.old_path):
+                system = self.oec_files.get(change.old_path)
+                if system is not None:
+                    self._remove_system(change.old_path, system)
+                    self.system_cache.remove(change.old_path)
+
+        entries = [(change.new_path, change.new_blob) for change in changes
+                   if is_system_file(change.new_path)]
+        systems = self._load_systems(entries)
+        for (key, blob_sha), system in zip(entries, systems):
+            self._add_system(key, system)
+        # the new versions may hold names in a different order than a full
+        # reload would have given them
+        self._resolve_names(set().union(*(system.all_names
+                                          for system in systems)))
+        logging.info("Reloaded %d changed system file(s)" % len(entries))
+
+    def _load_systems(self, entries: List[Tuple[str, Optional[str]]]) \
+            -> List[System]:
+        """
+        Loads system files, from the system cache if possible. Files missing
+        from the cache are parsed, in parallel if parse_workers is configured.
+        :param entries: List of tuples (key, blob sha) where key is the path
+        of a system file relative to the repository root. The blob sha is
+        hashed from the file if None.
+        :return: The systems, in the same order as the entries.
+        """
+        systems = []
+        missing = []    # indices of systems that need parsing
+        for key, blob_sha in entries:
+            system_file = os.path.join(self.oec_repo.root, *key.split('/'))
+            blob_sha = blob_sha or SystemCache.blob_sha(system_file)
+            system = self.system_cache.get(key, blob_sha)
+            if system is None:
+                missing.append((len(systems), key, blob_sha, system_file))
+            else:
+                system.file = system_file
+            systems.append(system)
+
+        parsed = self.oec_adapter.read_systems(
+                [system_file for _, _, _, system_file in missing],
+                self.parse_workers)
+        for (idx, key, blob_sha, system_file), system in zip(missing, parsed):
+            # quantities keep their fingerprints, so they are cached with
+            # the system and need no unit lookups on the next run
+            for planet in system.planets:
+                planet.fingerprint()
+            self.system_cache.put(key, blob_sha, system)
+            systems[idx] = system
+
+        logging.info("Loaded %d system file(s), parsed %d" %
+                     (len(systems), len(parsed)))
+        return systems
+
+    def _add_system(self, key: str, system: System) -> None:
+        """
+        Maps all alternate names of a loaded system to the system object.
+        :param key: Path of the system file relative to the repository root.
+        :param system: The system.
+        """
+        self.oec_files[key] = system
+        for sys_name in system.all_names:
+            if sys_name in self.oec_system:
+                # this means two different systems have the same name
+                logging.debug("Naming conflict between <%s> and <%s>"
+                              % (self.oec_system[sys_name].name,
+                                 system.name))
+                self._oec_shadowed.setdefault(sys_name, []).append(system)
+                continue
+            self.oec_system[sys_name] = system
+
+    def _remove_system(self, key: str, system: System) -> None:
+        """
+        Removes a system and all its names. A name the system held is handed
+        over to the first of the systems that lost a naming conflict over it.
+        :param key: Path of the system file relative to the repository root.
+        :param system: The system.
+        """
+        del self.oec_files[key]
+        for sys_name in system.all_names:
+            if self.oec_system.get(sys_name) is system:
+                del self.oec_system[sys_name]
+            shadowed = [s for s in self._oec_shadowed.get(sys_name, [])
+                        if s is not system]
+            self._oec_shadowed[sys_name] = shadowed
+        self._resolve_names(system.all_names)
+
+    def _system_order(self, system: System) -> Tuple[int, str]:
+        """
+        :return: Sort key of a system, following the order in which a full
+        reload loads the system files.
+        """
+        key = self._repo_path(system.file)
+        return Synchronizer.SYSTEM_PATHS.index(os.path.dirname(key)), key
+
+    def _resolve_names(self, names: Iterable[str]) -> None:
+        """
+        Hands every name to the system a full reload would have given it,
+        i.e. the first loaded system holding the name. The others are kept
+        as shadowed systems.
+        :param names: Names held by systems that were added or removed.
+        """
+        for sys_name in names:
+            holders = self._oec_shadowed.pop(sys_name, [])
+            winner = self.oec_system.pop(sys_name, None)
+            if winner is not None:
+                holders.append(winner)
+            if not holders:
+                continue
+            holders.sort(key=self._system_order)
+            self.oec_system[sys_name] = holders[0]
+            if len(holders) > 1:
+                self._oec_shadowed[sys_name] = holders[1:]
+
+    def _save_system_cache(self) -> None:
+        try:
+            self.system_cache.save()
+        except OSError as e:
+            logging.warning("Unable to save system cache: %s" % e)
+
+    def _save_unit_table(self) -> None:
+        try:
+            Quantity.save_unit_table(
+                    self._datapath(Synchronizer.DATAPATH_UNIT_TABLE))
+        except OSError as e:
+            logging.warning("Unable to save unit table: %s" % e)
 
     def _reload_cat_config(self) -> None:
         """
@@ -259,7 +626,9 @@ class Synchronizer:
             try:
                 with open(f, 'r') as fin:
                     cat_config = CatalogueConfig(fin)
-                    cat = MonitoredCatalogue(cat_config)
+                    cat = MonitoredCatalogue(
+                            cat_config,
+                            self._datapath(Synchronizer.DATAPATH_CATALOGUES))
                     self.cats.append(cat)
             except Exception as e:
                 logging.error('Failed loading config "%s": %s' % (f, e))
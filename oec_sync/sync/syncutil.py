@@ -6,7 +6,7 @@ import yaml
 
 
 # signature of progress callback function
-# parameters are(current, total, tag)
+# parameters are(current, total, tag), total is 0 when it is not known
 ProgressCallback = Callable[[int, int, Optional[str]], None]
 
 
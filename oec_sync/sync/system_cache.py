@@ -0,0 +1,118 @@
+from typing import Dict, Tuple, Optional, Iterable
+from model import System
+from blob_cache import BlobCache
+import logging
+import pickle
+import os
+
+
+class SystemCache:
+    """
+    On-disk cache of parsed OEC systems.
+
+    Every entry is keyed by the path of a system file (relative to the OEC
+    repository root) and tagged with the git blob SHA of the file content,
+    so a system only needs to be parsed again when its file changed.
+    """
+    # bump this whenever the pickled model classes change their layout
+    VERSION = 4
+
+    def __init__(self, cache_file: str):
+        """
+        :param cache_file: Path to the cache file, will be created on save.
+        """
+        self.cache_file = cache_file
+        # relative path -> (blob sha, system)
+        self.__entries = dict()
+        self.__dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def load(self) -> None:
+        """
+        Loads the cache file into memory. A missing, corrupted or outdated
+        cache file is silently discarded.
+        """
+        self.__entries.clear()
+        self.__dirty = False
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                version, entries = pickle.load(f)
+            if version != SystemCache.VERSION:
+                logging.info("Discarding system cache of version %r" %
+                             version)
+                return
+            self.__entries = entries
+            logging.debug("Loaded %d cached system(s)" % len(entries))
+        except Exception as e:
+            logging.warning("Failed loading system cache: %s" % e)
+
+    def save(self) -> None:
+        """
+        Writes the cache back to disk, if anything has changed.
+        """
+        if not self.__dirty:
+            return
+        # write to a temporary file first, so a crash never leaves
+        # a truncated cache behind
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((SystemCache.VERSION, self.__entries), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+        self.__dirty = False
+
+    def get(self, key: str, blob_sha: str) -> Optional[System]:
+        """
+        Looks up a parsed system.
+        :param key: Path of the system file relative to the repository root.
+        :param blob_sha: Current blob SHA of the system file.
+        :return: The cached system, or None if the file has changed.
+        """
+        entry = self.__entries.get(key)
+        if entry is None or entry[0] != blob_sha:
+            return None
+        return entry[1]
+
+    def put(self, key: str, blob_sha: str, system: System) -> None:
+        """
+        Adds a parsed system to the cache.
+        :param key: Path of the system file relative to the repository root.
+        :param blob_sha: Blob SHA of the parsed file content.
+        :param system: The parsed system.
+        """
+        self.__entries[key] = (blob_sha, system)
+        self.__dirty = True
+
+    def remove(self, key: str) -> None:
+        """
+        Drops a system file from the cache.
+        :param key: Path of the system file relative to the repository root.
+        """
+        if self.__entries.pop(key, None) is not None:
+            self.__dirty = True
+
+    def retain(self, keys: Iterable[str]) -> None:
+        """
+        Drops every entry that is not in the given set of keys.
+        :param keys: Paths of system files that still exist.
+        """
+        keys = set(keys)
+        for key in list(self.__entries):
+            if key not in keys:
+                self.remove(key)
+
+    @staticmethod
+    def blob_sha(file: str) -> str:
+        """
+        Computes the git blob SHA of a file, the same way `git hash-object`
+        does.
+        :param file: Path to the file.
+        :return: Hex digest.
+        """
+        with open(file, 'rb') as f:
+            return BlobCache.blob_sha(f.read())
@@ -1,21 +1,25 @@
-import shelve
 import requests
 import io
 import re
 import uuid
 import logging
 import enum
-import time
-import json
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Tuple, Union, Any
-from github import Github, UnknownObjectException
+from itertools import islice
+from typing import Tuple, Union, Any, Optional, Callable, List
+from github import Github, GithubException
 from github.PullRequest import PullRequest
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from model import PlanetarySysUpdate
 from syncutil import ProgressCallback
 from comparer import data_compare
+from request_store import RequestStore
+from blob_cache import BlobCache
 import oec
 
 
@@ -36,6 +40,99 @@ class ReconstructionError(Exception):
         super().__init__(msg)
 
 
+class FileFetcher:
+    """
+    Downloads the files changed by pull requests, over a pooled http session
+    that is shared between threads and retries transient failures.
+    """
+    # seconds to wait for the server
+    TIMEOUT = 30
+
+    # attempts and backoff for transient failures
+    RETRIES = 3
+    BACKOFF = 0.5   # seconds, doubled on every retry
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size: int=10,
+                 blob_cache: BlobCache=None,
+                 local_files: Callable[[str, str], Optional[bytes]]=None):
+        """
+        :param pool_size: Number of connections kept alive per host.
+        :param blob_cache: Keeps downloaded files, nothing is kept if None.
+        :param local_files: Reads (commit, path) from a local clone, returns
+        None if the commit is not there.
+        """
+        self.blob_cache = blob_cache
+        self.local_files = local_files
+
+        # url -> lock, so files shared by many pull requests (e.g. the same
+        # base file) are only downloaded by one thread
+        self.__url_locks = dict()
+        self.__url_locks_lock = threading.Lock()
+
+        # the urllib3 bundled with requests, so the adapter recognises it.
+        # Running out of retries raises a RetryError (a RequestException)
+        retry = Retry(total=self.RETRIES,
+                      backoff_factor=self.BACKOFF,
+                      status_forcelist=self.RETRY_STATUS)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __download(self, url: str) -> bytes:
+        try:
+            resp = self.session.get(url, timeout=self.TIMEOUT)
+        except requests.RequestException as e:
+            raise ReconstructionError('Unable to retrieve %s: %s' % (url, e))
+        if not resp.ok:
+            raise ReconstructionError('Unable to retrieve %s: %d %s' %
+                                      (url, resp.status_code, resp.reason))
+        return resp.content
+
+    def get_text(self, url: str, blob_sha: str=None) -> str:
+        """
+        Downloads a text file, unless it is cached.
+        :param url: Url of the file.
+        :param blob_sha: Git blob SHA of the file, if known.
+        :return: Content of the file.
+        """
+        content = None
+        if self.blob_cache and blob_sha:
+            content = self.blob_cache.get(blob_sha)
+        if content is None:
+            content = self.__download(url)
+            if self.blob_cache:
+                self.blob_cache.put(content)
+        return content.decode('utf-8')
+
+    def get_revision(self, url: str, commit: str, path: str) -> str:
+        """
+        Gets a text file at a specific commit, from the local clone if it has
+        the commit, or else from the cache or the url.
+        :param url: Url of the file at the commit.
+        :param commit: Commit hash.
+        :param path: Path of the file relative to the repository root.
+        :return: Content of the file.
+        """
+        content = None
+        if self.local_files:
+            content = self.local_files(commit, path)
+        if content is None and self.blob_cache:
+            with self.__url_locks_lock:
+                url_lock = self.__url_locks.setdefault(url, threading.Lock())
+            with url_lock:
+                content = self.blob_cache.get_ref(url)
+                if content is None:
+                    content = self.__download(url)
+                    self.blob_cache.put_ref(url, content)
+        elif content is None:
+            content = self.__download(url)
+        return content.decode('utf-8')
+
+
 @enum.unique
 class IgnoredRequest(enum.Enum):
     """
@@ -105,21 +202,29 @@ class UpdateRequest:
         return "#%(pullreq_num)s %(title)s" % self.__dict__
 
     @classmethod
-    def from_pull_request(cls, pr: PullRequest) \
+    def from_pull_request(cls, pr: PullRequest,
+                          fetcher: FileFetcher=None) \
             -> Union['UpdateRequest', IgnoredRequest]:
         """
         Construct from a Github pull request.
         :param pr: The pull request.
+        :param fetcher: Downloads the changed file, a new one if not given.
         :return: The constructed update request.
         """
-        if pr.is_merged():
+        fetcher = fetcher or FileFetcher(pool_size=1)
+
+        # use the fields in the pull request listing,
+        # anything else costs another API call
+        if pr.merged_at is not None:
             return IgnoredRequest.merged
 
-        if pr.changed_files != 1:
+        # two files are enough to tell it changes more than one
+        files = list(islice(pr.get_files(), 2))
+        if len(files) != 1:
             return IgnoredRequest.invalid
-        
+
         # system file after merge
-        file = pr.get_files()[0]
+        file = files[0]
 
         # construct download url of the original file
         orig_file = cls.FILE_URL.format(
@@ -129,19 +234,8 @@ class UpdateRequest:
         )
 
         # retrieve the original and patched files
-        resp = requests.get(orig_file)
-        if not resp.ok:
-            raise ReconstructionError('Unable to retrieve the original file: '
-                                      '%d %s' % (resp.status_code,
-                                                 resp.reason))
-        original = resp.text
-
-        resp = requests.get(file.raw_url)
-        if not resp.ok:
-            raise ReconstructionError('Unable to retrieve the original file: '
-                                      '%d %s' % (resp.status_code,
-                                                 resp.reason))
-        patched = resp.text
+        original = fetcher.get_revision(orig_file, pr.base.sha, file.filename)
+        patched = fetcher.get_text(file.raw_url, file.sha)
 
         # read xml and reconstruct system update object
         update = None
@@ -232,6 +326,9 @@ class CachedRequest:
     Cached update request. Just an update request with digest value.
     Collision is possible, need to check equivalence later.
     """
+    # bump this whenever get_checksum changes
+    CHECKSUM_VERSION = 2
+
     def __init__(self, req: UpdateRequest):
         assert req.pullreq_num > 0
         self.request = req
@@ -242,12 +339,9 @@ class CachedRequest:
         """
         Computes the checksum of an update request
         :param req: the update request
-        :return: the md5 checksum
+        :return: the canonical digest of the updates
         """
-        dump = json.dumps(req.updates,
-                          default=lambda o: o.__dict__,
-                          sort_keys=True)
-        return hashlib.md5(dump.encode('utf-8')).hexdigest()
+        return req.updates.digest()
 
 
 class DuplicateError(Exception):
@@ -264,16 +358,32 @@ class UpdateRequestDB:
     The database of all update requests.
     """
 
-    # minimum time until cache is refreshed
-    MIN_CACHE_LIFETIME = 180 * 60    # seconds
+    # number of pull requests per page when listing them
+    PAGE_SIZE = 100
+
+    # number of pull requests reconstructed at the same time
+    FETCH_WORKERS = 8
+
+    # number of reconstructed pull requests written in one transaction
+    COMMIT_BATCH = 50
 
-    def __init__(self, cache_file: str, api_token: str, repo_name: str):
+    def __init__(self, cache_file: str, api_token: str, repo_name: str,
+                 fetch_workers: int=FETCH_WORKERS,
+                 blob_cache: BlobCache=None,
+                 local_files: Callable[[str, str], Optional[bytes]]=None):
         """
         Loads the database into memory, from (Github and cache file).
         :param cache_file: Path to the cache file.
         :param api_token: Github API token.
+        :param fetch_workers: Number of pull requests reconstructed at the
+        same time.
+        :param blob_cache: Keeps the files of reconstructed pull requests.
+        :param local_files: Reads (commit, path) from a local OEC clone.
         """
-        self.github = Github(api_token)
+        self.fetch_workers = fetch_workers
+        self.fetcher = FileFetcher(fetch_workers, blob_cache, local_files)
+
+        self.github = Github(api_token, per_page=self.PAGE_SIZE)
         self.user = self.github.get_user()
 
         logging.info("Logged in as '%s' (%s)" % (self.user.login,
@@ -282,24 +392,37 @@ class UpdateRequestDB:
         logging.info("Repository found: '%s' (%s)" % (self.repo.full_name,
                                                       self.repo.html_url))
 
-        self.requests = shelve.open(cache_file, writeback=True)
+        self.requests = RequestStore(cache_file, UpdateRequestDB._describe)
 
         # validate cache
-        if len(self.requests) == 0:
+        if self.__get_meta('repo') is None:
             self.__init_db()
         elif not self.__validate_db():
             logging.info("Invalidating cache...")
             self.requests.clear()
             self.__init_db()
-
-        logging.info("Building request lookup table...")
-        self.__request_lookup = dict()
-        for num, req in self.requests.items():
-            if isinstance(req, CachedRequest):
-                self.__request_lookup[req.checksum] = req
+        elif self.__get_meta('checksum_version') != \
+                CachedRequest.CHECKSUM_VERSION:
+            self.__update_checksums()
 
     def __del__(self):
-        self.requests.close()
+        if hasattr(self, 'requests'):
+            self.requests.close()
+
+    @staticmethod
+    def _describe(value: Union['CachedRequest', IgnoredRequest]) \
+            -> Tuple[str, Optional[str]]:
+        """
+        Gets the indexed columns of a cache entry.
+        :param value: A cached request, or an ignored request.
+        :return: (state, checksum)
+        """
+        if isinstance(value, IgnoredRequest):
+            return value.name, None
+        if isinstance(value, CachedRequest):
+            state = 'rejected' if value.request.rejected else 'open'
+            return state, value.checksum
+        raise TypeError("Unknown item: %r" % value)
 
     def get_similar(self, req: UpdateRequest) -> CachedRequest:
         """
@@ -310,18 +433,31 @@ class UpdateRequestDB:
         # compute checksum
         req_checksum = CachedRequest.get_checksum(req)
         # find existing requests
-        return self.__request_lookup.get(req_checksum)
+        return self.requests.find(req_checksum)
 
     def __init_db(self):
         logging.info("Initializing cache...")
         self.__set_meta('repo', self.repo.full_name)
-        self.requests.sync()
+        self.__set_meta('checksum_version', CachedRequest.CHECKSUM_VERSION)
+        self.requests.commit()
+
+    def __update_checksums(self):
+        """
+        Recomputes the checksums of cached requests made by an older version.
+        """
+        logging.info("Updating request checksums...")
+        for key, value in self.requests.items():
+            if isinstance(value, CachedRequest):
+                value.checksum = CachedRequest.get_checksum(value.request)
+                self.requests[key] = value
+        self.__set_meta('checksum_version', CachedRequest.CHECKSUM_VERSION)
+        self.requests.commit()
 
     def __get_meta(self, key: str) -> Any:
-        return self.requests.get("META:"+key)
+        return self.requests.get_meta(key)
 
     def __set_meta(self, key: str, value: Any):
-        self.requests["META:"+key] = value
+        self.requests.set_meta(key, value)
 
     def __validate_db(self) -> bool:
         repo_name = self.__get_meta("repo")
@@ -335,58 +471,42 @@ class UpdateRequestDB:
                           % (repo_name, self.repo.full_name))
             return False
 
-        # check value types
-        meta_count = 0
-        ignored_count = 0
-        valid_count = 0
-        for key, value in self.requests.items():
-            if key.startswith("META:"):
-                meta_count += 1
-                continue
-            if isinstance(value, IgnoredRequest):
-                ignored_count += 1
-                continue
-            if isinstance(value, CachedRequest):
-                valid_count += 1
-                continue
-            logging.debug("Unknown item: %s -> %s" % (key, value))
-            return False
-
+        # values are checked when they are read, corrupted ones are dropped
+        states = self.requests.count_states()
         logging.info("Cache validatd: "
-                     "%d metadata, "
                      "%d requests, "
                      "%d ignored." %
-                     (meta_count, valid_count, ignored_count))
+                     (states.get('open', 0) + states.get('rejected', 0),
+                      states.get('merged', 0) + states.get('invalid', 0)))
         return True
 
-    def __cache_pull_request(self, pull: PullRequest) -> CachedRequest:
+    def __reconstruct(self, pull: PullRequest) \
+            -> Optional[Union[CachedRequest, IgnoredRequest]]:
         """
-        Puts pull request into cache.
+        Creates a cache entry from a pull request. Safe to run in parallel.
+        :return: The cache entry, None if the files could not be retrieved.
         """
         try:
-            pull_num = str(pull.number)
-
             # Create cached request from pull request
-            req = UpdateRequest.from_pull_request(pull)
+            req = UpdateRequest.from_pull_request(pull, self.fetcher)
 
             # Update requests need to be specially handled
             if isinstance(req, UpdateRequest):
                 req = CachedRequest(req)
-                original = self.requests.get(pull_num)
-                if original is not None:
-                    # remove lookup item of the old pull request
-                    if isinstance(original, CachedRequest):
-                        if original.checksum in self.__request_lookup:
-                            del self.__request_lookup[original.checksum]
-                # Update lookup table
-                self.__request_lookup[req.checksum] = req
-
-            # Add into db
-            self.requests[pull_num] = req
+            return req
 
         except ReconstructionError as e:
             # usually a network problem
             logging.debug(e)
+            return None
+
+    def __cache_pull_request(self, pull: PullRequest) -> CachedRequest:
+        """
+        Puts pull request into cache.
+        """
+        req = self.__reconstruct(pull)
+        if req is not None:
+            self.requests[str(pull.number)] = req
 
     def submit(self, req: UpdateRequest, force: bool=False):
         """
@@ -407,19 +527,101 @@ class UpdateRequestDB:
                 raise DuplicateError(similar_req.request.pullreq_num)
 
         # Submit the pull request
+        pr = self.__create_pull(req)
+        if pr:
+            self.fetch_one(pr.number)
+
+    def __create_pull(self, req: UpdateRequest) -> Optional[PullRequest]:
+        """
+        Creates the pull request of an update request whose branch has been
+        pushed, and updates the pull request into the update request object.
+        """
         pr = self.repo.create_pull(title=req.title,
                                    body=req.get_summary(),
                                    head=req.branch,
                                    base="master")
         if not pr:
             logging.info("Failed to created pull request")
-            return
+            return None
 
         req.pullreq_num = pr.number
         req.pullreq_url = pr.html_url
         logging.info("Created pull request #%d (%s)" %
                      (pr.number, pr.html_url))
-        self.fetch_one(pr.number)
+        return pr
+
+    def remove_duplicates(self, reqs: List[UpdateRequest]) \
+            -> List[UpdateRequest]:
+        """
+        Refreshes the cache once, then drops the requests that duplicate a
+        pull request, or an earlier request in the list.
+        :param reqs: Local update requests.
+        :return: The requests that are not duplicates.
+        """
+        self.fetch_all()
+        unique = []
+        checksums = set()
+        for req in reqs:
+            checksum = CachedRequest.get_checksum(req)
+            similar_req = self.requests.find(checksum)
+            if similar_req is not None:
+                logging.info("Skipping '%s', duplicate of #%d" %
+                             (req.title, similar_req.request.pullreq_num))
+            elif checksum in checksums:
+                logging.info("Skipping '%s', duplicate of another request"
+                             % req.title)
+            else:
+                checksums.add(checksum)
+                unique.append(req)
+        return unique
+
+    def submit_many(self, reqs: List[UpdateRequest]) -> List[UpdateRequest]:
+        """
+        Submits several update requests to Github at once, whose branches
+        have all been pushed. Duplicates are not checked here, see
+        remove_duplicates().
+        :param reqs: The requests to be submitted.
+        :return: The requests whose pull requests have been created.
+        """
+        for req in reqs:
+            assert req.branch is not None and req.branch != ""
+            assert req.pullreq_num == 0
+            assert req.pullreq_url is None
+
+        def create(req: UpdateRequest):
+            pr = self.__create_pull(req)
+            entry = None
+            if pr:
+                # the pull request exists now, failing to cache it only
+                # means it is fetched again by the next sync
+                try:
+                    entry = self.__reconstruct(pr)
+                except Exception as e:
+                    logging.warning("Unable to cache pull request #%d: %s"
+                                    % (pr.number, e))
+            return pr, entry
+
+        submitted = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) \
+                    as executor:
+                futures = {executor.submit(create, req): req
+                           for req in reqs}
+                # the store is only written from this thread
+                for future in as_completed(futures):
+                    try:
+                        pr, entry = future.result()
+                    except Exception as e:
+                        logging.error("Unable to create pull request for "
+                                      "'%s': %s" % (futures[future].title, e))
+                        continue
+                    if pr:
+                        submitted.append(futures[future])
+                        if entry is not None:
+                            self.requests[str(pr.number)] = entry
+        finally:
+            self.requests.commit()
+        return submitted
 
     def reject(self, req: UpdateRequest):
         """
@@ -440,93 +642,107 @@ class UpdateRequestDB:
         it in self.requests as a dictionary of
         pull request number -> CachedRequest object
 
-        We have two modes of synchronization:
-        - Full Sync:    Refresh all new/open requests.
-                        This will happen if an amount of time has elapsed
-                        since the last full sync.
-        - Partial Sync: Don't refresh the cached requests, but keep an eye on
-                        the newly added (open/closed) pull requests.
-
-        :param force_full_sync: Do a full sync, ignore last synchronized time.
-                     if set to false, will only discover new update requests.
+        Pull requests are listed by the time they were last updated, newest
+        first, a page at a time. We have two modes of synchronization:
+        - Full Sync:    Refresh all open requests, and any request updated
+                        since the last sync.
+                        This will happen if it is forced, or if no sync has
+                        recorded the time of the newest update yet.
+        - Partial Sync: Only refresh the requests updated since the last
+                        sync, the listing stops at the first older one.
+
+        :param force_full_sync: Do a full sync, ignore the time of the newest
+                     update seen by the last sync.
+                     if set to false, will only discover updated requests.
         :param progress
         """
         update_progress = progress or (lambda a, b, c=None: True)
 
-        # check if there's need to do a full sync
-        full_sync = True
-        if not force_full_sync:
-            timestamp = self.__get_meta("last_full_sync")
-            now = time.time()
-            if timestamp is not None:
-                if 0 < (now - timestamp) < self.MIN_CACHE_LIFETIME:
-                    logging.debug("Partial Sync: Last synced on %f"
-                                  % timestamp)
-                    full_sync = False
-                else:
-                    logging.debug("Full Sync: Last synced on %f"
-                                  % timestamp)
+        # time of the most recent update seen by the last sync
+        last_updated = self.__get_meta("last_updated_at")
+        full_sync = force_full_sync or last_updated is None
+        logging.debug("%s Sync: newest update seen on %s" %
+                      ("Full" if full_sync else "Partial", last_updated))
+        listed_updates = []     # update times of the listed pull requests
+        failed_updates = []     # update times of the ones that failed
 
         # set of pull request numbers fetched this time
         just_fetched = set()
 
-        # find open pull requests
-        max_pr_number = 1
-        if full_sync:
-            update_progress(0, 1, "Check for pending requests...")
-            pulls = self.repo.get_pulls("open")
+        # the number of updated requests is unknown until the listing stops
+        update_progress(0, 0, "Fetching updated requests...")
+        pulls = self.repo.get_pulls(state='all',
+                                    sort='updated',
+                                    direction='desc')
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            # pull requests are reconstructed while the next pages are listed
+            pending = dict()    # future -> pull request number
             for pull_idx, pull in enumerate(pulls):
-
-                update_progress(pull_idx, 100)
-
-                max_pr_number = max(max_pr_number, pull.number)
-                self.__cache_pull_request(pull)
-                just_fetched.add(pull.number)
-            update_progress(1, 1)
-
-        # Ensure all pull requests are cached.
-        # Also keep track of state of the previously open pull requests.
-        # These are the transitions we need to pay attention to:
-        # was open -> [merged|closed]
-        update_progress(0, max_pr_number, "Fetching new requests...")
-        pr_n = 0
-        while pr_n < 1e5:
-            pr_n += 1
-            pull_request_num = str(pr_n)
-            update_progress(pr_n, max_pr_number)
-
-            if pr_n in just_fetched:
-                continue
-
-            ur = self.requests.get(pull_request_num)
-            if ur is not None:
-                if not full_sync:
-                    # partial sync will skip as long as it's in cache
-                    continue
-
-                # pull request was marked as ignored
-                if isinstance(ur, IgnoredRequest):
-                    continue
-                elif isinstance(ur, UpdateRequest):
-                    if ur.rejected:
-                        continue
-
-            # otherwise, need to check for update to the pull request
-            try:
-                self.fetch_one(pr_n)
-                just_fetched.add(pr_n)
-            except UnknownObjectException:
-                # no such pull request - iteration is complete
-                break
-
-        update_progress(pr_n, pr_n)
+                updated = last_updated is None or \
+                    pull.updated_at > last_updated
+                if not updated and not full_sync:
+                    # everything from here on has been seen by the last sync
+                    break
+                listed_updates.append(pull.updated_at)
+                update_progress(pull_idx + 1, 0)
+
+                if not updated:
+                    # full sync only refreshes requests that are still open
+                    cached = self.requests.get(str(pull.number))
+                    if cached is not None:
+                        if isinstance(cached, IgnoredRequest):
+                            continue
+                        if cached.request.rejected:
+                            continue
+
+                future = executor.submit(self.__reconstruct, pull)
+                pending[future] = (pull.number, updated and pull.updated_at)
+
+            # the store is only written from this thread
+            update_progress(0, len(pending), "Reconstructing requests...")
+            for done, future in enumerate(as_completed(pending), 1):
+                update_progress(done, len(pending))
+                req = future.result()
+                num, updated_at = pending[future]
+                if req is not None:
+                    self.requests[str(num)] = req
+                    just_fetched.add(num)
+                elif updated_at:
+                    failed_updates.append(updated_at)
+                if done % self.COMMIT_BATCH == 0:
+                    self.requests.commit()
+
+        update_progress(1, 1)
         logging.info("Sync complete: updated %d item(s)" %
                      len(just_fetched))
-        if full_sync:
-            self.__set_meta("last_full_sync", time.time())
+        newest_update = self.__high_water_mark(last_updated, listed_updates,
+                                                failed_updates)
+        if newest_update is not None:
+            self.__set_meta("last_updated_at", newest_update)
 
         # commit changes
-        self.requests.sync()
+        self.requests.commit()
+
+    @staticmethod
+    def __high_water_mark(last_updated: Optional[datetime],
+                          listed: List[datetime],
+                          failed: List[datetime]) -> Optional[datetime]:
+        """
+        Finds the update time the next partial sync can stop at. It never
+        goes past a pull request that failed to be fetched, so the next
+        partial sync retries it.
+        :param last_updated: Update time the last sync stopped at.
+        :param listed: Update times of the pull requests listed.
+        :param failed: Update times of the updated pull requests that could
+        not be fetched.
+        :return: The new update time, None if nothing has been seen yet.
+        """
+        if failed:
+            oldest_failure = min(failed)
+            listed = [t for t in listed if t < oldest_failure]
+        if last_updated is not None:
+            listed.append(last_updated)
+        return max(listed, default=None)
 
     def fetch_one(self, pull_request_num: int):
         """
@@ -537,4 +753,4 @@ class UpdateRequestDB:
         self.__cache_pull_request(pull)
 
         # commit changes
-        self.requests.sync()
+        self.requests.commit()
@@ -0,0 +1,62 @@
+"""
+Measures the startup time of the application.
+
+Usage: python bench_startup.py [RUNS]
+
+Each case runs in a fresh python process, RUNS times (default 10), and the
+fastest and the median wall time are reported.
+"""
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+SRC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+
+CASES = [
+    ('driver.py --help', [os.path.join(SRC_ROOT, 'driver.py'), '--help']),
+    ('import synchronizer', ['-c', 'import synchronizer']),
+]
+
+
+def measure(args: list, runs: int) -> list:
+    """
+    Runs python with the arguments and times it.
+    :param args: Arguments to the python interpreter.
+    :param runs: Number of runs.
+    :return: Wall time of each run, in seconds.
+    :raises RuntimeError: If python exits with an error.
+    """
+    env = dict(os.environ)
+    paths = [os.path.join(SRC_ROOT, 'sync'), os.path.join(SRC_ROOT, 'gui')]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + args, env=env,
+                                cwd=SRC_ROOT, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            # a crashed process says nothing about the startup time
+            raise RuntimeError("%s exited with %d:\n%s" %
+                               (' '.join(args), result.returncode,
+                                result.stderr.decode(errors='replace')))
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, args in CASES:
+        times = measure(args, runs)
+        print("%-24s min %6.1f ms   median %6.1f ms" %
+              (name, 1000 * min(times), 1000 * statistics.median(times)))
+
+
+if __name__ == '__main__':
+    main()
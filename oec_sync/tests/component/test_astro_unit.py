@@ -1,5 +1,6 @@
 from tester_base import *
 from astro_unit import *
+import pickle
 
 
 class QuantityTest(BaseTestCase):
@@ -123,4 +124,96 @@ class QuantityTest(BaseTestCase):
             .can_update_error(
                 Quantity('1', error=('0', '3'), is_limit=True)
             )
-        )
\ No newline at end of file
+        )
+
+    def test_fingerprint(self):
+        q = Quantity('1.50', 'meter', ('0.1', '0.20'))
+        self.assertEqual(q.fingerprint(),
+                         Quantity('1.5', 'm', ('0.10', '0.2')).fingerprint(),
+                         "same value, unit and errors")
+        self.assertNotEqual(q.fingerprint(),
+                            Quantity('1.5', 'm', ('0.1', '0.3'))
+                            .fingerprint())
+        self.assertNotEqual(q.fingerprint(),
+                            Quantity('1.5', 'm').fingerprint())
+        self.assertNotEqual(q.fingerprint(),
+                            Quantity('1.5', 'km', ('0.1', '0.2'))
+                            .fingerprint())
+
+        # kept until the quantity changes
+        self.assertIs(q.fingerprint(), q.fingerprint())
+
+        # changes are picked up
+        q.value = '1.6'
+        self.assertEqual(Quantity('1.6', 'm', ('0.1', '0.2')).fingerprint(),
+                         q.fingerprint())
+
+    def test_pickle(self):
+        q = Quantity('1.50', 'meter', ('-0.1', '0.2'), True)
+        loaded = pickle.loads(pickle.dumps(q))
+        self.assertEqual(repr(q), repr(loaded))
+        self.assertIsNone(loaded._fingerprint, "not computed yet")
+        self.assertEqual(q.fingerprint(), loaded.fingerprint())
+        loaded = pickle.loads(pickle.dumps(q))
+        self.assertEqual(q.fingerprint(), loaded._fingerprint,
+                         "pickled with the quantity")
+        loaded.value = '1.6'
+        self.assertIsNone(loaded._fingerprint)
+
+        # quantities pickled before the fingerprint was
+        loaded = Quantity.__new__(Quantity)
+        loaded.__setstate__(('1.50', 'meter', ('-0.1', '0.2'), True))
+        self.assertEqual(q.fingerprint(), loaded.fingerprint())
+
+        # quantities pickled before they had slots
+        loaded = Quantity.__new__(Quantity)
+        loaded.__setstate__({'value': '1.50', 'unit': 'meter',
+                             'error': ('-0.1', '0.2'), 'is_limit': True})
+        self.assertEqual(q.fingerprint(), loaded.fingerprint())
+
+    def test_conversion_scale(self):
+        for value in ['1.2345e2', '0.001', '-17.5', '0']:
+            self.assertEqual(
+                str(Quantity._convert_pint(Decimal(value), 'M_e', 'M_j')),
+                Quantity(value, 'M_e').to('M_j').value,
+                "same digits as pint"
+            )
+        self.assertIsNotNone(Quantity._SCALES[('M_e', 'M_j')])
+
+        # offsets are left to pint
+        with self.assertRaises(Exception):
+            Quantity('1', 'K').to('degC')
+        self.assertIsNone(Quantity._SCALES[('K', 'degC')])
+
+    def test_unit_table(self):
+        table_file = os.path.join(self.data_path, 'units.json')
+        converted = Quantity('1.5', 'M_e', ('0.1', '0.2')).to('M_j')
+        self.assertEqual(Quantity('1.5', 'M_e'), Quantity('1.5', 'M_e'))
+        Quantity.save_unit_table(table_file)
+
+        registry = Quantity._UR
+        names, scales = Quantity._UNIT_NAMES, Quantity._SCALES
+        try:
+            # start over without a registry, the table is enough
+            Quantity._UR = None
+            Quantity._UNIT_NAMES, Quantity._SCALES = dict(), dict()
+            Quantity.load_unit_table(table_file)
+            self.assertEqual(repr(converted),
+                             repr(Quantity('1.5', 'M_e', ('0.1', '0.2'))
+                                  .to('M_j')))
+            self.assertEqual(Quantity('1.5', 'M_e'), Quantity('1.5', 'M_e'))
+            self.assertIsNone(Quantity._UR, "registry is loaded lazily")
+        finally:
+            Quantity._UR = registry
+            Quantity._UNIT_NAMES, Quantity._SCALES = names, scales
+
+    def test_canonical_unit(self):
+        q = Quantity('1', 'm')
+        self.assertIs(q._canonical_unit(), Quantity('1', 'meter')
+                      ._canonical_unit())
+        self.assertIsNone(Quantity('1')._canonical_unit())
+
+        q.unit = 'km'
+        self.assertIs(Quantity('1', 'kilometer')._canonical_unit(),
+                      q._canonical_unit())
+        self.assertNotEqual(Quantity('1', 'm'), q)
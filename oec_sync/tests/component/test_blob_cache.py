@@ -0,0 +1,35 @@
+from tester_base import *
+from blob_cache import *
+import subprocess
+
+
+class BlobCacheTest(BaseTestCase):
+    SAMPLE = os.path.join(BaseTestCase.TESTS_ROOT, 'test_sample',
+                          'KOI-0012.xml')
+
+    def test_get_put(self):
+        cache = BlobCache(os.path.join(self.data_path, 'blobs'))
+        with open(self.SAMPLE, 'rb') as f:
+            content = f.read()
+        expected = subprocess.check_output(
+            ['git', 'hash-object', self.SAMPLE]).decode().strip()
+
+        self.assertIsNone(cache.get(expected))
+        self.assertEqual(expected, cache.put(content))
+        self.assertEqual(content, cache.get(expected))
+        self.assertEqual(content, BlobCache(cache.root).get(expected),
+                         "blobs should persist")
+
+        url = 'https://example.com/oec/abc/systems/KOI-0012.xml'
+        self.assertIsNone(cache.get_ref(url))
+        self.assertEqual(expected, cache.put_ref(url, content))
+        self.assertEqual(content, cache.get_ref(url))
+
+    def test_corrupted(self):
+        cache = BlobCache(os.path.join(self.data_path, 'blobs'))
+        blob_sha = cache.put(b'some content')
+        blob_file = os.path.join(cache.root, 'objects',
+                                 blob_sha[:2], blob_sha[2:])
+        with open(blob_file, 'wb') as f:
+            f.write(b'other content')
+        self.assertIsNone(cache.get(blob_sha))
@@ -1,6 +1,7 @@
 from tester_base import *
 from catalogue import *
 import io
+import time
 
 
 SAMPLE = """
@@ -75,3 +76,183 @@ class CatalogueConfigTest(BaseTestCase):
         with open(configfile, 'r') as f:
             c = CatalogueConfig(f)
             self.assertEqual('Exoplanet.eu', c.name)
+
+
+class MonitoredCatalogueTest(BaseTestCase):
+
+    def test_fetch_debug_file(self):
+        configfile = SrcPath.abs('sync_config', 'exoplanet.yml')
+        with open(configfile, 'r') as f:
+            c = CatalogueConfig(f)
+        c.raw['debug_file'] = 'tests/catalogues/exoplanet.eu.csv'
+
+        cat = MonitoredCatalogue(c)
+        cat.fetch()
+        planet = cat.systems['11 Com'].planets[0]
+        self.assertEqual('11 Com b', planet.name)
+        self.assertEqual(Quantity('19.4', 'M_j', ('1.5', '1.5')),
+                         planet.prop['mass'])
+        self.assertNotIn('radius', planet.prop, "empty values are skipped")
+
+    def test_fetch_conditional(self):
+        configfile = SrcPath.abs('sync_config', 'exoplanet.yml')
+        with open(configfile, 'r') as f:
+            c = CatalogueConfig(f)
+        with open(SrcPath.abs('tests', 'catalogues', 'exoplanet.eu.csv'),
+                  'rb') as f:
+            content = [f.read()]
+        etag = ['"v1"']
+
+        def handler(path, headers):
+            if headers.get('If-None-Match') == etag[0]:
+                return 304, {}, b''
+            return 200, {'ETag': etag[0],
+                         'Content-Type': 'text/csv; charset=utf-8'}, \
+                content[0]
+
+        snapshot_root = os.path.join(self.data_path, 'catalogues')
+        with LocalHttpServer(handler) as server:
+            c.url = server.url('/catalog/csv')
+            cat = MonitoredCatalogue(c, snapshot_root)
+            self.assertTrue(cat.fetch())
+            systems = cat.systems
+            self.assertIn('11 Com', systems)
+            self.assertNotIn('If-None-Match', server.requests[-1][1])
+
+            # not modified: keep the systems
+            self.assertFalse(cat.fetch())
+            self.assertIs(systems, cat.systems)
+            self.assertEqual('"v1"', server.requests[-1][1]['If-None-Match'])
+
+            # new etag, same content: keep the systems
+            etag[0] = '"v2"'
+            self.assertFalse(cat.fetch())
+            self.assertIs(systems, cat.systems)
+
+            # a new instance reads the snapshot without downloading it again
+            cat = MonitoredCatalogue(c, snapshot_root)
+            self.assertTrue(cat.fetch())
+            self.assertIn('11 Com', cat.systems)
+            self.assertEqual('"v2"', server.requests[-1][1]['If-None-Match'])
+
+            # changed content
+            etag[0] = '"v3"'
+            content[0] = content[0].replace(b'\n11 Com b,19.4,',
+                                            b'\n11 Com b,19.5,')
+            self.assertTrue(cat.fetch())
+            self.assertEqual('19.5',
+                             cat.systems['11 Com'].planets[0]
+                             .prop['mass'].value)
+
+    def test_fetch_timeout(self):
+        configfile = SrcPath.abs('sync_config', 'exoplanet.yml')
+        with open(configfile, 'r') as f:
+            c = CatalogueConfig(f)
+        self.assertEqual(CatalogueConfig.DEFAULT_TIMEOUT, c.timeout)
+        c.timeout = 0.1
+
+        def handler(path, headers):
+            time.sleep(0.5)
+            return 200, {}, b''
+
+        with LocalHttpServer(handler) as server:
+            c.url = server.url('/catalog/csv')
+            cat = MonitoredCatalogue(c)
+            cat.systems = dict()
+            with self.assertRaises(requests.Timeout):
+                cat.fetch()
+            self.assertIsNone(cat.systems)
+
+    def test_changed_systems(self):
+        configfile = SrcPath.abs('sync_config', 'exoplanet.yml')
+        with open(configfile, 'r') as f:
+            c = CatalogueConfig(f)
+        with open(SrcPath.abs('tests', 'catalogues', 'exoplanet.eu.csv'),
+                  'rb') as f:
+            content = f.read()
+        debug_file = os.path.join(self.data_path, 'exoplanet.eu.csv')
+        c.raw['debug_file'] = debug_file
+        snapshot_root = os.path.join(self.data_path, 'catalogues')
+
+        def write(data: bytes):
+            with open(debug_file, 'wb') as f:
+                f.write(data)
+
+        write(content)
+        cat = MonitoredCatalogue(c, snapshot_root)
+        cat.fetch()
+        self.assertIsNone(cat.changed_systems, "nothing synced yet")
+        cat.commit('abc', full=True)
+        self.assertEqual(set(), cat.changed_systems)
+
+        # change a row, remove a system and add another one
+        content = content.replace(b'\n11 Com b,19.4,', b'\n11 Com b,19.5,')
+        content = content.replace(b',11 Oph,', b',New Star,')
+        write(content)
+
+        # the synced rows are kept across instances
+        cat = MonitoredCatalogue(c, snapshot_root)
+        self.assertEqual('abc', cat.synced_oec_head)
+        self.assertGreater(cat.last_full_sync, 0)
+        cat.fetch()
+        self.assertEqual({'11 Com', '11 Oph', 'New Star'},
+                         cat.changed_systems)
+
+        # until committed, the changes are reported again
+        cat.fetch()
+        self.assertEqual({'11 Com', '11 Oph', 'New Star'},
+                         cat.changed_systems)
+        cat.commit('def')
+        cat.fetch()
+        self.assertEqual(set(), cat.changed_systems)
+
+    def test_blank_lines(self):
+        configfile = SrcPath.abs('sync_config', 'exoplanet.yml')
+        with open(configfile, 'r') as f:
+            c = CatalogueConfig(f)
+        with open(SrcPath.abs('tests', 'catalogues', 'exoplanet.eu.csv'),
+                  'r') as f:
+            lines = f.read().splitlines(keepends=True)
+        c.raw['debug_file'] = SrcPath.abs('tests', 'catalogues',
+                                          'exoplanet.eu.csv')
+        cat = MonitoredCatalogue(c)
+        cat.fetch()
+        expected = list(cat.systems)
+
+        # blank lines in between, a row without a system name, and
+        # trailing blank lines
+        debug_file = os.path.join(self.data_path, 'exoplanet.eu.csv')
+        c.raw['debug_file'] = debug_file
+        with open(debug_file, 'w') as f:
+            f.writelines(lines[:2] + ['\n', ',' * 10 + '\n'] + lines[2:])
+            f.write('\n\n')
+        cat = MonitoredCatalogue(c)
+        cat.fetch()
+        self.assertNotIn(None, cat.systems)
+        self.assertNotIn('', cat.systems)
+        self.assertEqual(expected, list(cat.systems))
+
+    def test_systems_built_lazily(self):
+        built = []
+
+        def read_system(name, rows):
+            built.append(name)
+            return System(name, planets=[Planet(r[0], name) for r in rows])
+
+        systems = CatalogueSystems({'A': [('A b',), ('A c',)], 'B': []},
+                                   read_system)
+        self.assertEqual(2, len(systems))
+        self.assertEqual(['A', 'B'], list(systems))
+        self.assertIn('B', systems)
+        self.assertEqual([], built, "nothing built yet")
+
+        self.assertEqual(2, len(systems['A'].planets))
+        self.assertIs(systems['A'], systems['A'])
+        self.assertEqual(['A'], built)
+        with self.assertRaises(KeyError):
+            systems['C']
+
+    def test_iter_lines(self):
+        chunks = ['a,"b\n', 'c"\r\nd,', 'e\n', 'f,g']
+        rows = list(csv.reader(MonitoredCatalogue._iter_lines(chunks)))
+        self.assertEqual([['a', 'b\nc'], ['d', 'e'], ['f', 'g']], rows)
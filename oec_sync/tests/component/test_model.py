@@ -1,5 +1,6 @@
 from tester_base import *
 from model import *
+import pickle
 
 
 class BodyTest(BaseTestCase):
@@ -48,6 +49,36 @@ class PlanetTest(BaseTestCase):
             "spacing and capitalization should not matter"
         )
 
+    def test_fingerprint(self):
+        oec_planet = Planet('KOI-0012 b', 'KOI-0012', prop={
+            'radius': Quantity('1.22115', 'R_j', ('0.6', '0.6')),
+            'period': Quantity('17.855149', 'd')
+        })
+        cat_planet = Planet('KOI-0012 b', 'KOI-0012', prop={
+            'radius': Quantity('1.221150', 'R_j', ('0.60', '0.60'))
+        })
+        self.assertLessEqual(cat_planet.fingerprint(),
+                             oec_planet.fingerprint(),
+                             "nothing to update")
+
+        cat_planet.prop['radius'].error = ('0.5', '0.6')
+        self.assertFalse(cat_planet.fingerprint() <=
+                         oec_planet.fingerprint())
+
+        # follows changes to the properties
+        fingerprint = oec_planet.fingerprint()
+        oec_planet.prop['mass'] = Quantity('1.5', 'M_j')
+        self.assertEqual(3, len(oec_planet.fingerprint()))
+        del oec_planet.prop['mass']
+        self.assertEqual(fingerprint, oec_planet.fingerprint())
+        oec_planet.prop = {}
+        self.assertEqual(frozenset(), oec_planet.fingerprint())
+
+        # pickled with the quantities of the planet
+        loaded = pickle.loads(pickle.dumps(cat_planet))
+        self.assertEqual(cat_planet.fingerprint(), loaded.fingerprint())
+        self.assertIsNotNone(loaded.prop['radius']._fingerprint)
+
 
 class SystemTest(BaseTestCase):
 
@@ -59,6 +90,33 @@ class SystemTest(BaseTestCase):
         self.assertEqual(system_a, System('system A'))
         self.assertNotEqual(system_a, system_b)
 
+    def test_find_planet(self):
+        planet_b = Planet('Kepler-47 b', 'Kepler-47', {'KOI-3154 b'})
+        planet_c = Planet('Kepler-47 c', 'Kepler-47', {'KOI-3154 c'})
+        dup_b = Planet('KOI-3154 b', 'Kepler-47')
+        system = System('Kepler-47', planets=[planet_b, planet_c, dup_b])
+
+        self.assertIs(planet_b, system.find_planet(dup_b),
+                      "first match wins, like list.index")
+        self.assertIs(planet_c,
+                      system.find_planet(Planet('KOI-3154C', 'Kepler-47')))
+        self.assertIsNone(system.find_planet(Planet('Kepler-47 d',
+                                                    'Kepler-47')))
+        self.assertIsNone(system.find_planet(Planet('Kepler-47 b',
+                                                    'KOI-3154')),
+                          "different system")
+
+        # the index follows changes to the planets
+        planet_d = Planet('Kepler-47 d', 'Kepler-47')
+        system.update_planets(planet_d)
+        self.assertIs(planet_d, system.find_planet(Planet('Kepler-47 d',
+                                                          'Kepler-47')))
+        system.update_planets(Planet('Kepler-47 b', 'Kepler-47',
+                                     {'Kepler-47 e'}), planet_b)
+        self.assertIs(dup_b, system.find_planet(planet_b))
+        self.assertIsNotNone(system.find_planet(Planet('Kepler-47 e',
+                                                       'Kepler-47')))
+
 
 class PlanetUpdateTest(BaseTestCase):
 
@@ -80,3 +138,48 @@ class PlanetarySysUpdateTest(BaseTestCase):
         self.assertEqual(repr(update_a),
                          "PlanetarySysUpdate('my update', False, [])")
         self.assertNotEqual(repr(update_a), repr(update_b))
+
+    def test_digest(self):
+        update = PlanetarySysUpdate('KOI-0012', planets=[
+            PlanetUpdate('KOI-0012 b', fields={
+                'radius': Quantity('1.22115', 'R_j', ('0.6', '0.6')),
+                'period': Quantity('17.855149', 'days')
+            }),
+            PlanetUpdate('KOI-0012 c', fields={
+                'eccentricity': Quantity('0.0')
+            })
+        ])
+        same = PlanetarySysUpdate('KOI-0012', planets=[
+            PlanetUpdate('KOI-0012 c', fields={
+                'eccentricity': Quantity('0')
+            }),
+            PlanetUpdate('KOI-0012 b', fields={
+                'period': Quantity('17.8551490', 'days'),
+                'radius': Quantity('1.22115', 'R_j', ('0.60', '0.6'))
+            })
+        ])
+        self.assertEqual(update.digest(), same.digest(),
+                         "order and trailing zeros should not matter")
+
+        digest = update.digest()
+        update.planets[1].fields['eccentricity'].value = '0.1'
+        self.assertNotEqual(digest, update.digest(),
+                            "changes should invalidate the digest")
+        update.planets[1].fields['eccentricity'].value = '0'
+        self.assertEqual(digest, update.digest())
+        update.planets[1].fields['mass'] = Quantity('1.5', 'M_j')
+        self.assertNotEqual(digest, update.digest())
+        del update.planets[1].fields['mass']
+        self.assertEqual(digest, update.digest())
+        update.add_update(PlanetUpdate('KOI-0012 d'))
+        self.assertNotEqual(digest, update.digest())
+        update.planets.pop()
+        self.assertEqual(digest, update.digest())
+
+        # not pickled with the update
+        loaded = pickle.loads(pickle.dumps(update))
+        self.assertNotIn('_digest', loaded.__dict__)
+        self.assertEqual(digest, loaded.digest())
+
+        update.name = 'KOI-0013'
+        self.assertNotEqual(digest, update.digest())
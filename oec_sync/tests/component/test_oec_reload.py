@@ -0,0 +1,81 @@
+from tester_base import *
+from synchronizer import *
+import test_repo_manager
+
+
+def system_xml(names: List[str], mass: str='1.0') -> str:
+    return ('<system>%s<star><planet><name>%s b</name><mass>%s</mass>'
+            '</planet></star></system>\n'
+            % (''.join('<name>%s</name>' % name for name in names),
+               names[0], mass))
+
+
+class OecReloadTest(BaseTestCase):
+    """
+    Reloading only the changed system files after a pull must give the
+    same systems as loading every file again.
+    """
+    def synchronizer(self, repo: RepoManager, name: str) -> Synchronizer:
+        # only the parts of the synchronizer that load OEC
+        sync = Synchronizer.__new__(Synchronizer)
+        sync.oec_repo = repo
+        sync.oec_adapter = oec.Adapter()
+        sync.parse_workers = 1
+        sync.oec_system = dict()
+        sync.oec_files = dict()
+        sync._oec_shadowed = dict()
+        sync._oec_head = ''
+        sync.system_cache = SystemCache(path.join(self.data_path, name))
+        sync._reload_oec()
+        return sync
+
+    @staticmethod
+    def snapshot(sync: Synchronizer) -> tuple:
+        """
+        :return: Name -> file of the system holding it, and name -> files
+        of the systems shadowed.
+        """
+        def key(system: System) -> str:
+            return sync._repo_path(system.file)
+        return ({name: key(system) for name, system in
+                 sync.oec_system.items()},
+                {name: [key(system) for system in systems]
+                 for name, systems in sync._oec_shadowed.items() if systems},
+                {key: system.planets[0].prop['mass'].value
+                 for key, system in sync.oec_files.items()})
+
+    def test_incremental_reload(self):
+        upstream, remote_path = test_repo_manager.RepoManagerTest \
+            .make_remote(self.data_path, {
+                'systems/A.xml': system_xml(['A', 'Shared']),
+                'systems/B.xml': system_xml(['B', 'Shared', 'Other']),
+                'systems/C.xml': system_xml(['C', 'Other']),
+                'systems/D.xml': system_xml(['D'])})
+        repo = RepoManager(path.join(self.data_path, 'oec'),
+                           'file://' + remote_path)
+        sync = self.synchronizer(repo, 'incremental.cache')
+        self.assertEqual('A.xml',
+                         path.basename(sync.get_system_file('Shared')))
+
+        # modify the file winning a contested name, rename one losing a
+        # conflict, delete one, and add one winning a conflict
+        upstream.git.mv('systems/C.xml', 'systems/E.xml')
+        upstream.git.rm('systems/D.xml')
+        test_repo_manager.RepoManagerTest.commit_files(upstream, {
+            'systems/A.xml': system_xml(['A', 'Shared'], '2.0'),
+            'systems/0.xml': system_xml(['Zero', 'Other'])}, "Second")
+        upstream.remote('remote').push('master')
+
+        old_head, new_head = repo.pull()
+        sync._reload_oec(old_head, new_head)
+        self.assertEqual(new_head, sync._oec_head)
+        expected = self.snapshot(self.synchronizer(repo, 'full.cache'))
+        self.assertEqual(expected, self.snapshot(sync))
+        self.assertEqual('systems/A.xml', expected[0]['shared'])
+        self.assertEqual('systems/0.xml', expected[0]['other'])
+        self.assertEqual({'shared': ['systems/B.xml'],
+                          'other': ['systems/B.xml', 'systems/E.xml']},
+                         expected[1])
+        self.assertEqual('2.0', expected[2]['systems/A.xml'])
+        self.assertNotIn('d', sync.oec_system)
+        self.assertNotIn('systems/D.xml', expected[2])
@@ -56,3 +56,223 @@ class RepoManagerTest(BaseTestCase):
         self.assertIsNone(repo.oec)
         self.assertTrue(repo.root == "")
         self.assertFalse(path.isdir(repo_path))
+
+    @staticmethod
+    def commit_files(repo: git.Repo, files: Dict[str, str], msg: str) -> str:
+        """
+        Writes files into a repository and commits them.
+        :return: Commit hash.
+        """
+        for name, content in files.items():
+            file = path.join(repo.working_tree_dir, name)
+            os.makedirs(path.dirname(file), exist_ok=True)
+            with open(file, 'w') as f:
+                f.write(content)
+        repo.index.add(list(files))
+        actor = git.Actor('OEC Sync Test', 'test@example.com')
+        return repo.index.commit(msg, author=actor, committer=actor).hexsha
+
+    @staticmethod
+    def make_remote(root: str, files: Dict[str, str]) -> Tuple[git.Repo, str]:
+        """
+        Creates an upstream repository with one commit, and a local bare
+        repository standing in for its remote.
+        :param root: Folder to create both in.
+        :param files: Files of the first commit.
+        :return: The upstream repository, where new commits can be pushed
+        from to 'remote', and the path of the bare repository.
+        """
+        upstream = git.Repo.init(path.join(root, 'upstream'))
+        RepoManagerTest.commit_files(upstream, files, "First")
+        remote_path = path.join(root, 'remote.git')
+        upstream.git.clone('--bare', upstream.working_tree_dir, remote_path)
+        git.Repo(remote_path).git.config('uploadpack.allowFilter', 'true')
+        upstream.create_remote('remote', remote_path)
+        return upstream, remote_path
+
+    def test_shallow_clone(self):
+        upstream, remote_path = self.make_remote(self.data_path, {
+            'systems/A.xml': 'A1',
+            'systems_kepler/B.xml': 'B1',
+            'images/C.png': 'C1'})
+        self.commit_files(upstream, {'systems/A.xml': 'A2'}, "Second")
+        upstream.remote('remote').push('master')
+
+        repo_path = path.join(self.data_path, 'oec')
+        repo = RepoManager(repo_path, 'file://' + remote_path,
+                           sparse_paths=['systems'], depth=1)
+        self.assertEqual(repo_path, repo.root)
+        self.assertEqual(upstream.head.commit.hexsha, repo.head())
+        self.assertEqual(1, len(list(repo.oec.iter_commits())),
+                         "only the latest commit should be cloned")
+        self.assertTrue(path.isfile(path.join(repo_path, 'systems', 'A.xml')))
+        self.assertFalse(path.exists(path.join(repo_path, 'systems_kepler')))
+        self.assertFalse(path.exists(path.join(repo_path, 'images')))
+        self.assertEqual(['systems/A.xml'], list(repo.list_blobs('systems')))
+
+        # pulls are shallow too
+        old_head = repo.head()
+        new_head = self.commit_files(upstream, {'systems/D.xml': 'D1',
+                                                'images/E.png': 'E1'}, "Third")
+        upstream.remote('remote').push('master')
+        self.assertEqual((old_head, new_head), repo.pull())
+        self.assertTrue(path.isfile(path.join(repo_path, 'systems', 'D.xml')))
+        self.assertFalse(path.exists(path.join(repo_path, 'images')))
+        self.assertEqual(['systems/D.xml'],
+                         [c.new_path for c in repo.diff(old_head, new_head,
+                                                        ['systems'])])
+
+        # branches are built without touching the working tree
+        commit_hash = repo.commit_file('update-a', 'systems/A.xml', 'A3\n',
+                                       "Update A")
+        self.assertTrue(commit_hash)
+        self.assertFalse(repo.oec.is_dirty(untracked_files=True))
+        self.assertEqual(b'A3\n', repo.read_file(commit_hash,
+                                                 'systems/A.xml'))
+        self.assertEqual(['update-a'], repo.push_branches(['update-a']))
+        self.assertEqual(commit_hash,
+                         git.Repo(remote_path).commit('update-a').hexsha)
+
+    def test_prune_branches(self):
+        _, remote_path = self.make_remote(self.data_path,
+                                          {'systems/A.xml': 'A1'})
+        repo = RepoManager(path.join(self.data_path, 'oec'),
+                           'file://' + remote_path)
+
+        pushed = repo.commit_file('pushed', 'systems/A.xml', 'A2', "A2")
+        repo.commit_file('local', 'systems/A.xml', 'A3', "A3")
+        self.assertEqual(pushed, repo.find_branch('pushed').commit.hexsha)
+        self.assertIsNone(repo.find_branch('missing'))
+        self.assertEqual(['pushed'], repo.push_branches(['pushed']))
+
+        # branches created behind the manager's back are still found
+        repo.oec.git.branch('merged', 'master')
+        self.assertIsNotNone(repo.find_branch('merged'))
+
+        # merged and pushed branches go, unpushed work stays
+        self.assertEqual(2, repo.prune_branches())
+        self.assertEqual(['local', 'master'],
+                         sorted(head.name for head in repo.oec.heads))
+        self.assertIsNone(repo.find_branch('pushed'))
+        self.assertIsNotNone(repo.find_branch('local'))
+        self.assertEqual(0, repo.prune_branches())
+
+        # pruning can be limited to once in a while
+        repo.oec.git.branch('merged', 'master')
+        self.assertEqual(0, repo.prune_branches(3600))
+        self.assertIsNotNone(repo.find_branch('merged'))
+        self.assertEqual(1, repo.prune_branches(0))
+
+    def test_worktree_pool(self):
+        _, remote_path = self.make_remote(self.data_path, {
+            'systems/%d.xml' % i: str(i) for i in range(8)})
+        repo = RepoManager(path.join(self.data_path, 'oec'),
+                           'file://' + remote_path, worktrees=2)
+        master = repo.head()
+
+        # leases never exceed the pool size, and are reset to master
+        with repo.worktree() as first, repo.worktree() as second:
+            self.assertNotEqual(first.git_dir, second.git_dir)
+            first.git.read_tree('--empty')
+        with repo.worktree() as tree:
+            self.assertIn(tree.git_dir, (first.git_dir, second.git_dir))
+            self.assertEqual(master, tree.head.commit.hexsha)
+            self.assertEqual(8, len(tree.index.entries))
+
+        changes = [('update-%d' % i, 'systems/%d.xml' % i, 'new %d\n' % i,
+                    "Update %d" % i) for i in range(8)]
+        commits = repo.build_branches(changes)
+        self.assertEqual(8, len(commits))
+        for branch_name, file_path, content, msg in changes:
+            self.assertEqual(content.encode(),
+                             repo.read_file(commits[branch_name], file_path))
+            self.assertEqual(commits[branch_name],
+                             repo.find_branch(branch_name).commit.hexsha)
+        self.assertEqual(2, len(repo.oec.git.worktree('list').splitlines())
+                         - 1)
+        self.assertEqual(master, repo.head())
+        self.assertFalse(repo.oec.is_dirty(untracked_files=True))
+
+    def test_pull_diff(self):
+        upstream, remote_path = self.make_remote(self.data_path, {
+            'systems/A.xml': 'A1',
+            'systems/B.xml': 'B1',
+            'systems/C.xml': 'C1',
+            'images/D.png': 'D1'})
+        repo = RepoManager(path.join(self.data_path, 'oec'),
+                           'file://' + remote_path)
+
+        # nothing came in
+        old_head = repo.head()
+        self.assertEqual((old_head, old_head), repo.pull())
+        self.assertEqual([], repo.diff(old_head, old_head))
+
+        # modify A, rename B, delete C, outside of systems too
+        upstream.git.mv('systems/B.xml', 'systems/E.xml')
+        upstream.git.rm('systems/C.xml')
+        new_head = self.commit_files(upstream, {'systems/A.xml': 'A2',
+                                                'images/D.png': 'D2'},
+                                     "Second")
+        upstream.remote('remote').push('master')
+        self.assertEqual((old_head, new_head), repo.pull())
+        self.assertEqual(new_head, repo.head())
+
+        changes = sorted(repo.diff(old_head, new_head, ['systems']),
+                         key=lambda c: c.old_path or c.new_path)
+        self.assertEqual([('M', 'systems/A.xml', 'systems/A.xml'),
+                          ('R', 'systems/B.xml', 'systems/E.xml'),
+                          ('D', 'systems/C.xml', None)],
+                         [(c.change_type, c.old_path, c.new_path)
+                          for c in changes])
+        self.assertEqual(upstream.commit(new_head).tree['systems/A.xml']
+                         .hexsha, changes[0].new_blob)
+        self.assertIsNone(changes[2].new_blob)
+        self.assertEqual(4, len(repo.diff(old_head, new_head)))
+        self.assertIsNone(repo.diff(old_head, '0' * 40))
+
+    def test_commit_file(self):
+        _, remote_path = self.make_remote(self.data_path, {
+            'systems/A.xml': 'A1\n',
+            'systems/B.xml': 'B1\n'})
+        repo = RepoManager(path.join(self.data_path, 'oec'),
+                           'file://' + remote_path)
+        master = repo.head()
+
+        # local changes, one staged and one not, must survive
+        with open(path.join(repo.root, 'systems', 'A.xml'), 'w') as f:
+            f.write('staged\n')
+        repo.oec.index.add(['systems/A.xml'])
+        with open(path.join(repo.root, 'systems', 'B.xml'), 'w') as f:
+            f.write('unstaged\n')
+        staged = repo.oec.git.diff('--cached')
+        unstaged = repo.oec.git.diff()
+
+        commit_hash = repo.commit_file('update-a', 'systems/A.xml',
+                                       'A2\r\n', "Update A")
+        commits = repo.build_branches([
+            ('update-b', 'systems/B.xml', 'B2\n', "Update B"),
+            ('update-c', 'systems/C.xml', 'C1\n', "Add C")])
+        self.assertEqual(['update-b', 'update-c'], sorted(commits))
+
+        # the content is written as-is, on top of master
+        self.assertEqual(b'A2\r\n', repo.read_file(commit_hash,
+                                                   'systems/A.xml'))
+        self.assertEqual(b'B1\n', repo.read_file(commit_hash,
+                                                 'systems/B.xml'))
+        self.assertEqual(b'C1\n', repo.read_file(commits['update-c'],
+                                                 'systems/C.xml'))
+        commit = repo.oec.commit(commit_hash)
+        self.assertEqual([master], [p.hexsha for p in commit.parents])
+        self.assertEqual("Update A", commit.message.strip())
+
+        # nothing else moved
+        self.assertEqual(master, repo.head())
+        self.assertEqual('master', repo.oec.active_branch.name)
+        self.assertEqual(staged, repo.oec.git.diff('--cached'))
+        self.assertEqual(unstaged, repo.oec.git.diff())
+
+        # an existing branch is never overwritten
+        self.assertEqual('', repo.commit_file('update-a', 'systems/A.xml',
+                                              'A3\n', "Update A again"))
+        self.assertEqual(commit_hash,
+                         repo.find_branch('update-a').commit.hexsha)
@@ -0,0 +1,89 @@
+from tester_base import *
+from request_store import *
+from update_request import UpdateRequestDB, CachedRequest, IgnoredRequest, \
+    UpdateRequest
+from contextlib import closing
+import pickle
+import shelve
+import sqlite3
+
+
+class RequestStoreTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_file = os.path.join(self.data_path, 'requests.db')
+
+    def open(self) -> RequestStore:
+        store = RequestStore(self.db_file, UpdateRequestDB._describe)
+        self.addCleanup(store.close)
+        return store
+
+    @staticmethod
+    def cached_request(num: int, rejected: bool=False) -> CachedRequest:
+        return CachedRequest(UpdateRequest(RandomData.system_update(),
+                                           pullreq_num=num,
+                                           rejected=rejected))
+
+    def test_get_put(self):
+        store = self.open()
+        req = self.cached_request(1)
+        store['1'] = req
+        store['2'] = IgnoredRequest.merged
+        store['3'] = self.cached_request(3, rejected=True)
+        store.set_meta('repo', 'teammask/DBTest')
+
+        self.assertEqual(3, len(store))
+        self.assertEqual(['1', '2', '3'], list(store))
+        self.assertEqual(req.checksum, store['1'].checksum)
+        self.assertIs(IgnoredRequest.merged, store['2'])
+        self.assertIsNone(store.get('4'))
+        self.assertEqual({'open': 1, 'merged': 1, 'rejected': 1},
+                         store.count_states())
+        self.assertEqual(1, store.find(req.checksum).request.pullreq_num)
+        self.assertIsNone(store.find('no such checksum'))
+        with self.assertRaises(TypeError):
+            store['5'] = 'a string'
+
+        del store['3']
+        with self.assertRaises(KeyError):
+            del store['3']
+        store.close()
+        store = self.open()
+        self.assertEqual(2, len(store))
+        self.assertEqual('teammask/DBTest', store.get_meta('repo'))
+
+        store.clear()
+        self.assertEqual(0, len(store))
+        self.assertIsNone(store.get_meta('repo'))
+
+    def test_corrupted(self):
+        store = self.open()
+        store['1'] = self.cached_request(1)
+        store['2'] = IgnoredRequest.invalid
+        store.commit()
+        store.close()
+
+        with closing(sqlite3.connect(self.db_file)) as conn, conn:
+            conn.execute("UPDATE requests SET data = ? WHERE num = 1",
+                         (pickle.dumps('a string'),))
+
+        store = self.open()
+        self.assertEqual([('2', IgnoredRequest.invalid)], store.items())
+        self.assertNotIn('1', store)
+
+    def test_migrate_shelve(self):
+        req = self.cached_request(1)
+        with shelve.open(self.db_file) as cache:
+            cache['META:repo'] = 'teammask/DBTest'
+            cache['1'] = req
+            cache['2'] = IgnoredRequest.merged
+            cache['3'] = 'unknown item'
+
+        store = self.open()
+        self.assertEqual('teammask/DBTest', store.get_meta('repo'))
+        self.assertEqual(['1', '2'], list(store))
+        self.assertEqual(req.checksum, store['1'].checksum)
+
+        # migration only happens once
+        store.close()
+        self.assertEqual(2, len(self.open()))
@@ -0,0 +1,55 @@
+from tester_base import *
+from system_cache import *
+from oec import Adapter
+import subprocess
+
+
+class SystemCacheTest(BaseTestCase):
+    SAMPLE = os.path.join(BaseTestCase.TESTS_ROOT, 'test_sample',
+                          'KOI-0012.xml')
+
+    def test_blob_sha(self):
+        expected = subprocess.check_output(
+            ['git', 'hash-object', self.SAMPLE]).decode().strip()
+        self.assertEqual(expected, SystemCache.blob_sha(self.SAMPLE))
+
+    def test_get_put(self):
+        cache = SystemCache(os.path.join(self.data_path, 'systems.cache'))
+        self.assertEqual(0, len(cache))
+
+        system = Adapter().read_system(self.SAMPLE)
+        cache.put('systems/KOI-0012.xml', 'abc', system)
+        self.assertIs(system, cache.get('systems/KOI-0012.xml', 'abc'))
+        self.assertIsNone(cache.get('systems/KOI-0012.xml', 'def'),
+                          "should miss if the file has changed")
+        self.assertIsNone(cache.get('systems/KOI-0049.xml', 'abc'))
+
+        cache.retain(['systems/KOI-0049.xml'])
+        self.assertIsNone(cache.get('systems/KOI-0012.xml', 'abc'))
+
+    def test_save_load(self):
+        cache_file = os.path.join(self.data_path, 'systems.cache')
+        cache = SystemCache(cache_file)
+        system = Adapter().read_system(self.SAMPLE)
+        cache.put('systems/KOI-0012.xml', 'abc', system)
+        cache.save()
+
+        loaded = SystemCache(cache_file).get('systems/KOI-0012.xml', 'abc')
+        self.assertIsNotNone(loaded)
+        self.assertEqual(system.name, loaded.name)
+        self.assertEqual(system.all_names, loaded.all_names)
+        self.assertEqual(len(system.planets), len(loaded.planets))
+        self.assertEqual(system.planets[0].prop['radius'],
+                         loaded.planets[0].prop['radius'])
+
+        # outdated cache files are discarded
+        SystemCache.VERSION += 1
+        try:
+            self.assertEqual(0, len(SystemCache(cache_file)))
+        finally:
+            SystemCache.VERSION -= 1
+
+        # so are corrupted ones
+        with open(cache_file, 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(0, len(SystemCache(cache_file)))
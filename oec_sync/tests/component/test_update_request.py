@@ -1,6 +1,14 @@
 from tester_base import *
 from update_request import *
 from syncutil import Helper, SrcPath
+from contextlib import closing
+from request_store import RequestStore
+from blob_cache import BlobCache
+from datetime import datetime
+from types import SimpleNamespace
+from typing import List
+import pickle
+import sqlite3
 
 
 class UpdateRequestTest(BaseTestCase):
@@ -95,6 +103,53 @@ class UpdateRequestTest(BaseTestCase):
         )
 
 
+class FakePull:
+    """
+    A pull request as returned by the listing.
+    """
+    def __init__(self, number: int, updated_at: datetime,
+                 merged: bool=False, raw_url: str=None, sha: str=None):
+        self.number = number
+        self.updated_at = updated_at
+        self.merged_at = updated_at if merged else None
+        self.state = 'open'
+        self.title = 'Update KOI-0012'
+        self.body = 'Reference: UpdateRequestDBTest'
+        self.html_url = None
+        self.base = SimpleNamespace(sha='base',
+                                    repo=SimpleNamespace(full_name='oec'))
+        self.head = SimpleNamespace(label='fork:%d' % number)
+        self.files = []
+        if raw_url:
+            self.files.append(SimpleNamespace(
+                filename='systems/KOI-0012.xml', raw_url=raw_url, sha=sha))
+        self.files_listed = 0
+
+    def get_files(self):
+        self.files_listed += 1
+        return iter(self.files)
+
+
+class FakeRepo:
+    def __init__(self, pulls: List[FakePull]):
+        self.pulls = pulls
+        self.pulls_listed = 0
+
+    def get_pulls(self, state: str, sort: str, direction: str):
+        assert (state, sort, direction) == ('all', 'updated', 'desc')
+        for pull in sorted(self.pulls, key=lambda p: p.updated_at,
+                           reverse=True):
+            self.pulls_listed += 1
+            yield pull
+
+    def create_pull(self, title: str, body: str, head: str, base: str):
+        if head.startswith('fail'):
+            raise ConnectionError('connection reset')
+        pull = FakePull(len(self.pulls) + 1, datetime(2017, 2, 1))
+        self.pulls.append(pull)
+        return pull
+
+
 class UpdateRequestDBTest(BaseTestCase):
     """
     This test class is based on the repository:
@@ -113,8 +168,8 @@ class UpdateRequestDBTest(BaseTestCase):
         self.assertGreater(len(db.requests), 7)
 
         # initialize with different repository
-        with shelve.open(db_name) as cache:
-            cache['repo'] = 'SOMETHING ELSE'
+        db.requests.set_meta('repo', 'SOMETHING ELSE')
+        db.requests.close()
         db = UpdateRequestDB(db_name,
                              config['gh_api_token'],
                              self.DB_REPO_NAME)
@@ -124,17 +179,214 @@ class UpdateRequestDBTest(BaseTestCase):
         self.assertGreater(len(db.requests), 7)
 
         # initialize with corrupted data
-        with shelve.open(db_name) as cache:
-            cache['1'] = None
-            cache['2'] = 'a string'
-            cache['3'] = 123
-            cache['4'] = ['42', None]
-            cache['5'] = 3.14
-            cache['6'] = {1, 2, 34}
+        db.requests.close()
+        with closing(sqlite3.connect(db_name)) as conn, conn:
+            corrupted = [None, 'a string', 123, ['42', None], 3.14, {1, 2}]
+            conn.execute("UPDATE requests SET data = ? WHERE num = 1",
+                         (b'garbage',))
+            for num, value in enumerate(corrupted, 2):
+                conn.execute("UPDATE requests SET data = ? WHERE num = ?",
+                             (pickle.dumps(value), num))
         db = UpdateRequestDB(db_name,
                              config['gh_api_token'],
                              self.DB_REPO_NAME)
-        self.assertLess(len(db.requests), 7)
+        # corrupted entries are dropped when they are read
+        valid = dict(db.requests.items())
+        for num in range(1, 8):
+            self.assertNotIn(str(num), valid)
+        self.assertEqual(len(valid), len(db.requests))
+
+    def offline_db(self, pulls: List[FakePull]) -> UpdateRequestDB:
+        """
+        Creates a db that never talks to Github.
+        """
+        db = UpdateRequestDB.__new__(UpdateRequestDB)
+        db.requests = RequestStore(os.path.join(self.data_path, "requests.db"),
+                                   UpdateRequestDB._describe)
+        db.fetch_workers = UpdateRequestDB.FETCH_WORKERS
+        db.fetcher = FileFetcher(db.fetch_workers)
+        db.repo = FakeRepo(pulls)
+        return db
+
+    def test_fetch_listing(self):
+        pulls = [FakePull(1, datetime(2017, 1, 1), merged=True),
+                 FakePull(2, datetime(2017, 1, 3)),
+                 FakePull(3, datetime(2017, 1, 2))]
+        db = self.offline_db(pulls)
+
+        # nothing has been seen yet, everything is listed
+        db.fetch_all()
+        self.assertEqual(3, db.repo.pulls_listed)
+        self.assertEqual(IgnoredRequest.merged, db.requests['1'])
+        self.assertEqual(IgnoredRequest.invalid, db.requests['2'])
+        self.assertEqual(IgnoredRequest.invalid, db.requests['3'])
+        self.assertEqual(0, pulls[0].files_listed,
+                         "merged requests should not be looked into")
+
+        # only requests updated since the last sync are listed
+        pulls.append(FakePull(4, datetime(2017, 1, 4)))
+        pulls[2].updated_at = datetime(2017, 1, 5)
+        db.repo = FakeRepo(pulls)
+        calls = []
+        db.fetch_all(progress=lambda current, total, tag=None:
+                     calls.append((current, total)))
+        self.assertEqual(3, db.repo.pulls_listed)
+        self.assertEqual([(0, 0), (1, 0), (2, 0)], calls[:3],
+                         "requests are counted while the total is unknown")
+        self.assertEqual(2, pulls[2].files_listed)
+        self.assertEqual(1, pulls[1].files_listed)
+        self.assertIn('4', db.requests)
+
+        # ignored requests are not refreshed, even in a full sync
+        db.repo = FakeRepo(pulls)
+        db.fetch_all(force_full_sync=True)
+        self.assertEqual(4, db.repo.pulls_listed)
+        self.assertEqual(1, pulls[1].files_listed)
+
+    @staticmethod
+    def original_file() -> bytes:
+        with open(os.path.join(BaseTestCase.TESTS_ROOT, 'test_sample',
+                               'KOI-0012.xml'), 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def patched_file(num: int) -> bytes:
+        """
+        :return: The sample system, with the planet radius set to num.
+        """
+        radius = b'<radius errorminus="0.60146" errorplus="0.60146">'
+        return UpdateRequestDBTest.original_file().replace(
+            radius + b'1.22115', radius + b'%d.22115' % num)
+
+    def test_fetch_concurrent(self):
+        original = self.original_file()
+        failed_once = set()
+
+        def handler(path, headers):
+            if path == '/oec/base/systems/KOI-0012.xml':
+                return 200, {}, original
+            num = int(path.rsplit('/', 1)[1])
+            if num == 5:
+                return 404, {}, b''
+            if num % 3 == 0 and num not in failed_once:
+                # transient failure, should be retried
+                failed_once.add(num)
+                return 503, {}, b''
+            return 200, {}, self.patched_file(num)
+
+        with LocalHttpServer(handler) as server:
+            self.addCleanup(setattr, UpdateRequest, 'FILE_URL',
+                            UpdateRequest.FILE_URL)
+            UpdateRequest.FILE_URL = server.url('/{repo}/{commit}/{file}')
+            pulls = [FakePull(num, datetime(2017, 1, num),
+                              raw_url=server.url('/head/%d' % num))
+                     for num in range(2, 22)]
+            db = self.offline_db(pulls)
+            db.fetch_all(force_full_sync=True)
+
+        self.assertNotIn('5', db.requests,
+                         "missing files should not be cached")
+        for pull in pulls:
+            if pull.number == 5:
+                continue
+            req = db.requests[str(pull.number)].request
+            self.assertEqual(pull.number, req.pullreq_num)
+            self.assertEqual('UpdateRequestDBTest', req.reference)
+            radius = req.updates.planets[0].fields['radius']
+            self.assertEqual('%d.22115' % pull.number, radius.value)
+        self.assertEqual({3, 6, 9, 12, 15, 18, 21}, failed_once)
+
+    def test_fetch_retry_failed(self):
+        failed_once = set()
+
+        def handler(path, headers):
+            if path == '/oec/base/systems/KOI-0012.xml':
+                return 200, {}, self.original_file()
+            num = int(path.rsplit('/', 1)[1])
+            if num == 3 and num not in failed_once:
+                failed_once.add(num)
+                return 404, {}, b''
+            return 200, {}, self.patched_file(num)
+
+        with LocalHttpServer(handler) as server:
+            self.addCleanup(setattr, UpdateRequest, 'FILE_URL',
+                            UpdateRequest.FILE_URL)
+            UpdateRequest.FILE_URL = server.url('/{repo}/{commit}/{file}')
+            pulls = [FakePull(num, datetime(2017, 1, num),
+                              raw_url=server.url('/head/%d' % num))
+                     for num in (2, 3, 4)]
+            db = self.offline_db(pulls)
+            db.fetch_all(force_full_sync=True)
+            self.assertEqual(['2', '4'], list(db.requests))
+
+            # the next partial sync does not stop before the failed one
+            db.repo = FakeRepo(pulls)
+            db.fetch_all()
+            self.assertEqual(['2', '3', '4'], list(db.requests))
+            self.assertEqual(3, db.repo.pulls_listed)
+
+            # and stops at the newest one once everything is fetched
+            db.repo = FakeRepo(pulls)
+            db.fetch_all()
+            self.assertEqual(1, db.repo.pulls_listed)
+
+    def test_fetch_cached(self):
+        def handler(path, headers):
+            if path == '/oec/base/systems/KOI-0012.xml':
+                return 200, {}, self.original_file()
+            return 200, {}, self.patched_file(int(path.rsplit('/', 1)[1]))
+
+        def read_local(commit, path):
+            if commit == 'local':
+                return self.original_file()
+            return None
+
+        with LocalHttpServer(handler) as server:
+            self.addCleanup(setattr, UpdateRequest, 'FILE_URL',
+                            UpdateRequest.FILE_URL)
+            UpdateRequest.FILE_URL = server.url('/{repo}/{commit}/{file}')
+            pulls = [FakePull(num, datetime(2017, 1, num),
+                              raw_url=server.url('/head/%d' % num),
+                              sha=BlobCache.blob_sha(self.patched_file(num)))
+                     for num in range(2, 6)]
+            db = self.offline_db(pulls)
+            db.fetcher = FileFetcher(
+                blob_cache=BlobCache(os.path.join(self.data_path, 'blobs')),
+                local_files=read_local)
+
+            db.fetch_all(force_full_sync=True)
+            self.assertEqual(5, len(server.requests),
+                             "the base file should only be downloaded once")
+
+            # everything is cached now
+            db.fetch_all(force_full_sync=True)
+            self.assertEqual(5, len(server.requests))
+
+            # base files are read from the local clone if it has the commit
+            pulls.append(FakePull(6, datetime(2017, 1, 6),
+                                  raw_url=server.url('/head/6')))
+            pulls[-1].base.sha = 'local'
+            db.fetch_all()
+            self.assertEqual(['/head/6'], [path for path, headers
+                                           in server.requests[5:]])
+        self.assertEqual('6.22115', db.requests['6'].request.updates
+                         .planets[0].fields['radius'].value)
+
+    def test_submit_many(self):
+        db = self.offline_db([])
+        db.fetch_workers = 1    # pull requests are numbered in order
+        reqs = [UpdateRequest(UpdateRequestTest.SAMPLE_UPDATE,
+                              reference='UpdateRequestDBTest')
+                for _ in range(4)]
+        reqs[1].branch = 'fail-1'
+        reqs[2].reference = ''    # the summary cannot be written
+
+        # failed requests are skipped, the others are still stored
+        self.assertEqual([reqs[0], reqs[3]], db.submit_many(reqs))
+        self.assertEqual([1, 0, 0, 2], [req.pullreq_num for req in reqs])
+        db.requests.close()
+        db = self.offline_db([])
+        self.assertEqual(['1', '2'], list(db.requests))
 
     def test_fetch(self):
         def verify_db(
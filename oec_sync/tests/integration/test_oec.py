@@ -1,5 +1,6 @@
 from tester_base import *
 from shutil import copyfile
+import glob
 from oec import *
 from astro_unit import Quantity
 
@@ -42,6 +43,20 @@ class AdapterTest(BaseTestCase):
             planet.prop['transittime']
         )
 
+    def test_read_systems(self):
+        adapter = Adapter()
+        files = sorted(glob.glob(os.path.join(self.TESTS_ROOT,
+                                              'test_sample', '*.xml')))
+        serial = adapter.read_systems(files)
+        parallel = adapter.read_systems(files, workers=2)
+
+        self.assertEqual(len(files), len(parallel))
+        for file, expected, system in zip(files, serial, parallel):
+            self.assertEqual(file, system.file)
+            self.assertEqual(expected.name, system.name)
+            self.assertEqual(expected.all_names, system.all_names)
+            self.assertEqual(len(expected.planets), len(system.planets))
+
     def test_read_system_alternate_names(self):
         adapter = Adapter()
         system = adapter.read_system(os.path.join(self.TESTS_ROOT,
@@ -198,3 +213,47 @@ class AdapterTest(BaseTestCase):
         self.assertEqual('42.679', planet_c_mass.value)
         self.assertEqual(('40', '49'), planet_c_mass.error)
         self.assertTrue(planet_c_mass.is_limit)
+
+    def test_update_str_many(self):
+        source_file = os.path.join(self.TESTS_ROOT,
+                                   'test_sample', '14 Her.xml')
+        with open(source_file, 'r') as f:
+            xml_string = f.read()
+
+        adapter = Adapter()
+        updates = [
+            # planets can be referred to by any of their names
+            PlanetarySysUpdate('14 Her', planets=[
+                PlanetUpdate('HD 145675 b',
+                             fields={'mass': Quantity('42.975')})]),
+            PlanetarySysUpdate('14 Her', planets=[
+                PlanetUpdate('14 Her b',
+                             fields={'mass': Quantity('43.975'),
+                                     'age': Quantity('42')}),
+                PlanetUpdate('14 Her c',
+                             fields={'mass': Quantity('42.679')})])
+        ]
+
+        # same result as applying the updates one by one
+        expected = xml_string
+        for update in updates:
+            expected, ok = adapter.update_str(expected, update)
+            self.assertTrue(ok)
+        content, ok = adapter.update_str_many(xml_string, updates)
+        self.assertTrue(ok)
+        self.assertEqual(expected, content)
+
+        # the parsed document keeps the edits until it is serialized
+        document = adapter.parse_str(content)
+        self.assertIs(document.planet('14 Her b'),
+                      document.planet('HD 145675 b'))
+        self.assertIsNone(document.planet('14 Her d'))
+        self.assertFalse(document.apply(PlanetarySysUpdate(
+            '14 Her', planets=[PlanetUpdate('14 Her d')])))
+        self.assertTrue(document.apply(updates[0]))
+        test_file = os.path.join(self.data_path, '14 Her.xml')
+        document.write(test_file)
+        system = adapter.read_system(test_file)
+        self.assertEqual('42.975', system.planets[0].prop['mass'].value)
+        self.assertEqual('42', system.planets[0].prop['age'].value)
+        self.assertEqual('42.679', system.planets[1].prop['mass'].value)
@@ -76,6 +76,37 @@ class SynchronizerTest(BaseTestCase):
         pull_id = syncr.submit(fake_request, force=True)
         self.assertGreater(pull_id, 0, "invalid pull request id")
 
+    def test_submit_many(self):
+        syncr = Synchronizer(SrcPath.abs('config.yml'),
+                             data_root=self.SHARED_PATH)
+
+        fake_requests = [
+            UpdateRequest(
+                PlanetarySysUpdate(
+                    '11 Com',
+                    planets=[
+                        PlanetUpdate(
+                            '11 Com b',
+                            fields={
+                                'mass': Quantity(mass, unit='M_j')
+                            }
+                        )
+                    ]
+                ),
+                title="[Test] - Update 11 Com",
+                message="Generated by SynchronizerTest.test_submit_many\n" +
+                        "Platform: " + platform.platform(),
+                reference="SynchronizerTest"
+            )
+            for mass in ('42', '43')
+        ]
+
+        # submit the requests as duplicates
+        submitted = syncr.submit_many(fake_requests, force=True)
+        self.assertEqual(2, len(submitted))
+        for req in submitted:
+            self.assertGreater(req.pullreq_num, 0, "invalid pull request id")
+
     def test_reject(self):
         syncr = Synchronizer(SrcPath.abs('config.yml'),
                              data_root=self.SHARED_PATH)
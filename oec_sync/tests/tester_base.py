@@ -5,6 +5,9 @@ import shutil
 import random
 import string
 import logging.config
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Tuple
 from datetime import datetime
 from model import *
 from syncutil import SrcPath
@@ -144,6 +147,59 @@ class BaseTestCase(unittest.TestCase):
         )
 
 
+class LocalHttpServer:
+    """
+    A local stand-in for a remote http server, running in a background thread.
+
+    Usage:
+        with LocalHttpServer(handler) as server:
+            requests.get(server.url('/some/file.csv'))
+    """
+    def __init__(self,
+                 handler: Callable[[str, Dict[str, str]],
+                                   Tuple[int, Dict[str, str], bytes]]):
+        """
+        :param handler: Called with (path, request headers) for every GET
+        request, returns a tuple of (status, response headers, body).
+        """
+        self.requests = []  # list of (path, request headers)
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                headers = dict(self.headers.items())
+                server.requests.append((self.path, headers))
+                status, resp_headers, body = handler(self.path, headers)
+                self.send_response(status)
+                for key, value in resp_headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self) -> 'LocalHttpServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def url(self, path: str) -> str:
+        """
+        :param path: Absolute path on the server, e.g. '/file.csv'.
+        :return: The full url.
+        """
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+
 class RandomData:
     ALPHANUM = string.ascii_letters + string.digits
 